@@ -0,0 +1,376 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Measure the time steeplechase itself spends on a test run.
+
+The clients are stand-ins for DeviceManagerSUT that work on local
+directories, with a configurable command latency and transfer speed. The
+browser is a script that fetches the test manifest from the controller and
+prints synthetic structured results for every test, as fast as it can.
+Everything the controller does around it is timed by phase, for a range of
+manifest sizes and output volumes."""
+
+from localdevice import LocalDevice
+from mozdevice import DMError
+from mozdevice.devicemanager import _pop_last_line
+from optparse import OptionParser
+
+import json
+import mozfile
+import os
+import runsteeplechase
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+class FakeDevice(object):
+    """A DeviceManagerSUT stand-in for a client on the local file system.
+    Every command takes |latency| seconds, and files are transferred at
+    |bandwidth| bytes per second."""
+
+    def __init__(self, root, latency, bandwidth):
+        self.files = LocalDevice(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def command(self, size=0):
+        time.sleep(self.latency + float(size) / self.bandwidth)
+
+    def getDeviceRoot(self):
+        return self.files.getDeviceRoot()
+
+    def fileExists(self, path):
+        self.command()
+        return self.files.fileExists(path)
+
+    def dirExists(self, path):
+        self.command()
+        return self.files.dirExists(path)
+
+    def mkDir(self, path):
+        self.command()
+        self.files.mkDir(path)
+
+    def removeDir(self, path):
+        self.command()
+        self.files.removeDir(path)
+
+    def removeFile(self, path):
+        self.command()
+        self.files.removeFile(path)
+
+    def listFiles(self, path):
+        self.command()
+        return self.files.listFiles(path)
+
+    def pushFile(self, local_path, path):
+        self.command(os.path.getsize(local_path))
+        self.files.pushFile(local_path, path)
+
+    def pushDir(self, local_dir, path):
+        size = 0
+        for root, dirs, files in os.walk(local_dir):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        self.command(size)
+        self.files.pushDir(local_dir, path)
+
+    def copyTree(self, source, destination):
+        self.command()
+        self.files.copyTree(source, destination)
+
+    def pullFile(self, path):
+        data = self.files.pullFile(path)
+        self.command(len(data))
+        return data
+
+    def getFile(self, path, local_path):
+        with open(local_path, 'wb') as f:
+            f.write(self.pullFile(path))
+
+    def shellCheckOutput(self, cmd, env=None, cwd=None):
+        self.command()
+        return self.files.shellCheckOutput(cmd, env=env, cwd=cwd)
+
+    def shell(self, cmd, outputfile, env=None, cwd=None, timeout=None, root=False):
+        """Run |cmd| and stream its output to |outputfile| the way
+        DeviceManagerSUT does, ending with its return code."""
+        self.command()
+        full_env = dict(os.environ)
+        full_env.update(env or {})
+        process = subprocess.Popen(" ".join(cmd), shell=True, cwd=cwd, env=full_env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        last = "\n"
+        while True:
+            data = os.read(process.stdout.fileno(), 64 * 1024)
+            if not data:
+                break
+            outputfile.write(data)
+            last = data[-1]
+        status = process.wait()
+        outputfile.write(("" if last == "\n" else "\n") + "return code [%d]" % status)
+        _pop_last_line(outputfile)
+        return status
+
+    def killProcess(self, appname, sig=None):
+        self.command()
+        try:
+            self.files.shellCheckOutput(["pkill", "-f", appname])
+        except DMError:
+            pass
+
+FAKE_BROWSER = """#!%(python)s
+# Fake browser written by steeplechase/benchmark.py.
+import json, re, sys, time
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+args = sys.argv[1:]
+profile = args[args.index("-profile") + 1]
+url = args[-1]
+prefs = {}
+for line in open(profile + "/prefs.js"):
+    m = re.match(r'user_pref\\("([^"]+)", (.*)\\);', line.strip())
+    if m:
+        prefs[m.group(1)] = json.loads(m.group(2))
+server = url[:url.index("/", len("http://"))]
+manifest = json.loads(urlopen(server + prefs["steeplechase.manifest_url"]).read())
+lines = %(lines)d
+out = sys.stdout
+def now():
+    return int(time.time() * 1000)
+for index, test in enumerate(manifest["tests"]):
+    if (index < prefs.get("steeplechase.start_test", 0) or
+        str(index) in prefs.get("steeplechase.skip_tests", "").split(",")):
+        continue
+    path = test["path"]
+    out.write(json.dumps({"action": "test_start", "index": index, "time": now(),
+                          "timeout": 300, "source_file": path}) + "\\n")
+    for i in range(lines):
+        if i %% 2:
+            out.write("[Child %%d] WARNING: synthetic browser output %%d of %%s\\n" %% (i, i, path))
+        else:
+            out.write(json.dumps({"action": "test_pass", "message": "check %%d" %% i,
+                                  "time": now(), "source_file": path}) + "\\n")
+    out.write(json.dumps({"action": "test_end", "status": "finished", "index": index,
+                          "time": now(), "load_time": 0, "handshake_time": 0,
+                          "run_time": 0, "source_file": path}) + "\\n")
+    out.flush()
+"""
+
+INSTALL_RDF = """<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:id>special-powers@mozilla.org</em:id>
+    <em:version>1.0</em:version>
+  </Description>
+</RDF>
+"""
+
+def write_file(path, data, mode=0644):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+def create_inputs(root, tests, lines, app_size):
+    """Create a fake application of |app_size| bytes, a manifest of |tests|
+    tests printing |lines| lines each and the other inputs of a run in
+    |root|. Return the command line arguments for them."""
+    app = os.path.join(root, "app")
+    write_file(os.path.join(app, "firefox"),
+               FAKE_BROWSER % {"python": sys.executable, "lines": lines}, 0755)
+    # Split the application into files of about 1MB like a real build.
+    chunk = 1024 * 1024
+    for i in range(0, app_size, chunk):
+        write_file(os.path.join(app, "lib", "lib%d.so" % (i / chunk)),
+                   os.urandom(min(chunk, app_size - i)))
+    write_file(os.path.join(root, "specialpowers", "install.rdf"), INSTALL_RDF)
+    write_file(os.path.join(root, "prefs.js"), "")
+    manifest = "".join("[test_%d.html]\n" % i for i in range(tests))
+    write_file(os.path.join(root, "tests", "manifest.ini"), manifest)
+    for i in range(tests):
+        write_file(os.path.join(root, "tests", "test_%d.html" % i), "<html></html>")
+    return ["--binary", os.path.join(app, "firefox"),
+            "--specialpowers-path", os.path.join(root, "specialpowers"),
+            "--prefs-file", os.path.join(root, "prefs.js"),
+            "--html-manifest", os.path.join(root, "tests", "manifest.ini"),
+            "--cache-dir", os.path.join(root, "cache"),
+            "--builtin-signalling"]
+
+class Probe(object):
+    """Time the phases of a run by wrapping the functions that do them."""
+
+    phases = ("asset push", "profile build", "profile push", "startup",
+              "result parsing", "teardown", "total")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = dict((phase, 0.0) for phase in self.phases)
+        self.launched = None
+        self.first_output = {}
+        self.finished = None
+        self.saved = []
+
+    def add(self, phase, duration):
+        with self.lock:
+            self.times[phase] += duration
+
+    def patch(self, owner, name, wrapper):
+        original = getattr(owner, name)
+        self.saved.append((owner, name, original))
+        setattr(owner, name, wrapper(original))
+
+    def timed(self, phase):
+        def wrapper(original):
+            def timed_call(*args, **kwargs):
+                start = time.time()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.add(phase, time.time() - start)
+            return timed_call
+        return wrapper
+
+    def install(self):
+        rs = runsteeplechase
+        self.patch(rs, "setup_clients", self.timed("asset push"))
+        self.patch(rs.HTMLTests, "base_profile", self.timed("profile build"))
+        self.patch(rs.HTMLTests, "push_profile", self.timed("profile push"))
+
+        def launch(original):
+            def wrapped(tests, *args, **kwargs):
+                if self.launched is None:
+                    self.launched = time.time()
+                return original(tests, *args, **kwargs)
+            return wrapped
+        self.patch(rs.HTMLTests, "launch", launch)
+
+        def write(original):
+            def wrapped(output, data):
+                start = time.time()
+                with self.lock:
+                    self.first_output.setdefault(output.name, start)
+                original(output, data)
+                self.add("result parsing", time.time() - start)
+            return wrapped
+        self.patch(rs.ClientOutput, "write", write)
+
+        def run(original):
+            def wrapped(thread):
+                original(thread)
+                with self.lock:
+                    self.finished = time.time()
+            return wrapped
+        self.patch(rs.RunThread, "run", run)
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.saved):
+            setattr(owner, name, original)
+        self.saved = []
+
+    def finish(self, start, end):
+        """Work out the phases that span others for a run from |start| to
+        |end|."""
+        if self.launched and self.first_output:
+            # Profile push happens during launch, before the browsers start.
+            self.times["startup"] = (max(self.first_output.values()) - self.launched -
+                                     self.times["profile push"])
+        if self.finished:
+            self.times["teardown"] = end - self.finished
+        self.times["total"] = end - start
+
+def run_scenario(tests, lines, options, log_stream):
+    """Run main() once on fake clients and return the time of each phase.
+    The output of the controller goes to |log_stream|."""
+    root = tempfile.mkdtemp(prefix="steeplechase-benchmark-")
+    passed = False
+    try:
+        args = create_inputs(root, tests, lines, options.app_size * 1024 * 1024)
+        hosts = ["fake%d" % i for i in range(options.pairs * 2)]
+        args += ["--hosts", ",".join(hosts),
+                 "--save-logs-to", root]
+        devices = dict((host, FakeDevice(os.path.join(root, host),
+                                         options.latency / 1000.0,
+                                         options.bandwidth * 1024 * 1024))
+                       for host in hosts)
+        probe = Probe()
+        probe.install()
+        create_device = runsteeplechase.create_device
+        runsteeplechase.create_device = lambda host: devices[host]
+        stdout, stderr = sys.stdout, sys.stderr
+        try:
+            # The controller logs every result, keep that out of the report.
+            sys.stdout = sys.stderr = log_stream
+            start = time.time()
+            passed = runsteeplechase.main(args)
+            end = time.time()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            runsteeplechase.create_device = create_device
+            probe.uninstall()
+        if not passed:
+            raise Exception("Benchmark run with %d tests failed, see the logs in %s" %
+                            (tests, root))
+        probe.finish(start, end)
+        return probe.times
+    finally:
+        if passed:
+            mozfile.remove(root)
+
+class BenchmarkOptions(OptionParser):
+    def __init__(self, **kwargs):
+        OptionParser.__init__(self, **kwargs)
+        self.add_option("--tests",
+                        action="store", type="string", dest="tests",
+                        default="10,100,500",
+                        help="comma separated manifest sizes to run")
+        self.add_option("--lines",
+                        action="store", type="string", dest="lines",
+                        default="10,1000",
+                        help="comma separated numbers of lines each test prints")
+        self.add_option("--pairs",
+                        action="store", type="int", dest="pairs",
+                        default=1,
+                        help="number of client pairs")
+        self.add_option("--latency",
+                        action="store", type="float", dest="latency",
+                        default=5,
+                        help="milliseconds each client command takes")
+        self.add_option("--bandwidth",
+                        action="store", type="float", dest="bandwidth",
+                        default=50,
+                        help="MB per second pushed to a client")
+        self.add_option("--app-size",
+                        action="store", type="int", dest="app_size",
+                        default=100,
+                        help="size of the application in MB")
+        self.add_option("--json",
+                        action="store", type="string", dest="json",
+                        help="also write the results as JSON to this file")
+
+def main(args):
+    parser = BenchmarkOptions()
+    options, args = parser.parse_args(args)
+    results = []
+    log_stream = open(os.devnull, "w")
+    print "%-6s %-6s " % ("tests", "lines") + " ".join("%15s" % p for p in Probe.phases)
+    for tests in [int(t) for t in options.tests.split(",")]:
+        for lines in [int(l) for l in options.lines.split(",")]:
+            times = run_scenario(tests, lines, options, log_stream)
+            results.append({"tests": tests, "lines": lines, "times": times})
+            print "%-6d %-6d " % (tests, lines) + " ".join("%14.2fs" % times[p]
+                                                           for p in Probe.phases)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
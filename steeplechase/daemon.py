@@ -0,0 +1,513 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Run steeplechase as a service that keeps the clients, their installed
+builds and the web server alive between runs. Runs are requested through a
+JSON API on localhost, queued, and run on free sessions of clients:
+
+    POST /api/runs          {"manifest": "/path/to/manifest.ini",
+                             "binary": "/path/to/firefox", "binary2": ...,
+                             "package": ..., "package2": ...,
+                             "sessions": 1, "options": {"concurrency": 2}}
+    GET  /api/runs          all runs, without their results
+    GET  /api/runs/<id>?since=N&wait=S
+                            the run with its results from the N-th on,
+                            waiting up to S seconds for new ones, and the
+                            outcome of each test and the errors outside of
+                            tests once it finished
+    GET  /api/status        the sessions of clients and the queue
+
+Each run writes its logs and reports to run-<id> in the log directory.
+"""
+
+from history import ResultsDatabase
+from mozhttpd import MozHttpd
+from mozhttpd.handlers import json_response
+from relay import SignallingRelay
+from report import errors_to_dict, summary
+from results import TestFailure, TestPass
+from runsteeplechase import (Options, client_role, create_device, read_hosts, read_manifest,
+                             report_results, report_timing, run_with_retries, select_tests,
+                             setup_clients)
+from static import StaticFiles
+from stats import StatsCollector
+from urlparse import parse_qs
+
+import copy
+import json
+import mozlog
+import moznetwork
+import os
+import re
+import sys
+import threading
+import time
+
+def int_option(value):
+    """Return the JSON number or string |value| as an int. Raises
+    ValueError if it isn't an integer."""
+    if isinstance(value, bool) or not isinstance(value, (int, long, basestring)):
+        raise ValueError("%s is not an integer" % json.dumps(value))
+    return int(value)
+
+def bool_option(value):
+    """Return the JSON boolean or "true"/"false" |value| as a bool. Raises
+    ValueError if it is anything else."""
+    if isinstance(value, bool):
+        return value
+    if value in ("true", "false"):
+        return value == "true"
+    raise ValueError("%s is not a boolean" % json.dumps(value))
+
+# The options a run request may set, with the functions that check them.
+RUN_OPTIONS = {"test_timeout": int_option,
+               "run_timeout": int_option,
+               "concurrency": int_option,
+               "preload": bool_option}
+# The longest a request for results waits for new ones, in seconds.
+MAX_WAIT = 30
+# The number of finished runs that are kept, older ones are forgotten.
+MAX_FINISHED_RUNS = 100
+# Options of runsteeplechase.py that are given with each run, or that would
+# write every run's report to the same file.
+PER_RUN_OPTIONS = ("html_manifest", "binary", "binary2", "package", "package2",
+                   "from_logs", "timing_report", "json_report", "xunit_report")
+
+class DaemonOptions(Options):
+    def __init__(self, **kwargs):
+        Options.__init__(self, **kwargs)
+        self.add_option("--port",
+                        action="store", type="int", dest="port",
+                        default=0,
+                        help="port of the web server the clients load the tests from")
+        self.add_option("--api-port",
+                        action="store", type="int", dest="api_port",
+                        default=8555,
+                        help="port on localhost to accept run requests on")
+
+def build_key(info):
+    """Return what identifies the build of a client: its path, size and
+    modification time. A build that is rebuilt in place is set up again."""
+    path = info['binary'] or info['package']
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime)
+
+class Run(object):
+    """A requested run of a manifest and its results so far."""
+
+    def __init__(self, id, manifest, tests, builds, sessions, options):
+        self.id = id
+        self.manifest = manifest
+        self.tests = tests
+        self.builds = builds
+        self.sessions = sessions
+        self.options = options
+        self.state = "queued"
+        self.error = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        # The records of the run from the |first_record|-th on. Those of a
+        # finished run are dropped once its final results were fetched.
+        self.records = []
+        self.first_record = 0
+        self.stats = StatsCollector()
+        # The MergedResults of the tests and the errors outside of tests
+        # once the run finished.
+        self.merged = None
+        self.errors = []
+        # The checks that passed and failed so far, on all clients.
+        self.check_passes = 0
+        self.check_failures = 0
+        self.condition = threading.Condition()
+
+    def add_record(self, client, record):
+        """Called by HTMLTests with each record of a client as it arrives."""
+        entry = dict(record.data)
+        entry["client"] = client
+        with self.condition:
+            self.records.append(entry)
+            if isinstance(record, TestPass):
+                self.check_passes += 1
+            elif isinstance(record, TestFailure):
+                self.check_failures += 1
+            self.condition.notify_all()
+
+    def set_state(self, state, error=None):
+        with self.condition:
+            self.state = state
+            if state == "running":
+                self.started = time.time()
+            elif state == "finished":
+                self.finished = time.time()
+                self.error = error
+            self.condition.notify_all()
+
+    def record_count(self):
+        return self.first_record + len(self.records)
+
+    def wait(self, since, timeout):
+        """Wait up to |timeout| seconds for more than |since| records or
+        the end of the run."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while (self.record_count() <= since and self.state != "finished" and
+                   time.time() < deadline):
+                self.condition.wait(deadline - time.time())
+
+    def to_dict(self, since=None):
+        """Return the run as a dict that can be written as JSON, with the
+        records from the |since|-th on unless it is None. Once the run
+        finished, its records are dropped after they were returned."""
+        with self.condition:
+            data = {"id": self.id,
+                    "state": self.state,
+                    "error": self.error,
+                    "manifest": self.manifest,
+                    "tests": len(self.tests),
+                    "queued": self.queued,
+                    "started": self.started,
+                    "finished": self.finished,
+                    "checks_passed": self.check_passes,
+                    "checks_failed": self.check_failures,
+                    "next": self.record_count()}
+            if self.merged is not None:
+                counts = summary(self.merged, self.errors)
+                data.update({"passed": counts["pass"],
+                             "failed": counts["fail"],
+                             "errors": counts["errors"]})
+            if since is not None:
+                data["results"] = self.records[max(since - self.first_record, 0):]
+                if self.merged is not None:
+                    data["outcomes"] = [test.to_dict() for test in self.merged]
+                    data["error_messages"] = errors_to_dict(self.errors)
+                if self.state == "finished":
+                    self.first_record += len(self.records)
+                    self.records = []
+            return data
+
+class Daemon(object):
+    """Keeps sessions of clients and a web server for them, and runs the
+    requested runs on free sessions as they become available, in the order
+    they were requested. A client's build is only set up when it differs
+    from the one of its last run."""
+
+    def __init__(self, options, hosts, log):
+        self.options = options
+        self.log = log
+        size = options.session_size
+        self.sessions = []
+        for s in range(len(hosts) / size):
+            session = []
+            for index, host in enumerate(hosts[s * size:(s + 1) * size]):
+                session.append({'dm': create_device(host),
+                                'host': host,
+                                'is_initiator': index == 0,
+                                'index': index,
+                                'role': client_role(options, index),
+                                'name': 'Client%d' % (s * size + index + 1)})
+            self.sessions.append(session)
+        self.free = list(self.sessions)
+        self.queue = []
+        self.runs = {}
+        self.next_id = 1
+        if options.log_dest:
+            # Continue after the runs of earlier daemons, their logs are kept.
+            for entry in os.listdir(options.log_dest):
+                match = re.match(r'run-(\d+)$', entry)
+                if match:
+                    self.next_id = max(self.next_id, int(match.group(1)) + 1)
+        self.stopping = False
+        self.condition = threading.Condition()
+
+        self.static = StaticFiles()
+        self.static.add_directory("/", os.path.join(os.path.dirname(__file__), "..", "webharness"))
+        handlers = []
+        self.relay = None
+        if options.builtin_signalling:
+            self.relay = SignallingRelay()
+            handlers.extend(self.relay.urlhandlers())
+        handlers.extend(self.stats_urlhandlers())
+        handlers.extend(self.static.urlhandlers())
+        # The request log would grow for as long as the daemon runs.
+        self.httpd = MozHttpd(host=moznetwork.get_ip(), port=options.port,
+                              log_requests=False, urlhandlers=handlers)
+        self.api = MozHttpd(host="127.0.0.1", port=options.api_port,
+                            log_requests=False, urlhandlers=self.urlhandlers())
+        self.scheduler = threading.Thread(target=self.schedule, name="scheduler")
+
+    def start(self):
+        self.httpd.start(block=False)
+        self.api.start(block=False)
+        self.scheduler.start()
+        self.log.info("Serving tests on port %d, accepting runs on port %d",
+                      self.httpd.httpd.server_port, self.api.httpd.server_port)
+
+    def stop(self):
+        """Stop accepting runs and wait for the running ones to finish."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.scheduler.join()
+        self.api.stop()
+        if self.relay:
+            self.relay.close()
+        self.httpd.stop()
+
+    def submit(self, request):
+        """Queue the run described by the dict |request| and return it.
+        Raises ValueError if the request is invalid."""
+        if not isinstance(request, dict):
+            raise ValueError("The request must be an object")
+        manifest = request.get("manifest")
+        if not isinstance(manifest, basestring) or not os.path.isfile(manifest):
+            raise ValueError("Manifest %s does not exist" % manifest)
+        binary, package = request.get("binary"), request.get("package")
+        if bool(binary) == bool(package):
+            raise ValueError("Need either binary or package")
+        binary2, package2 = request.get("binary2"), request.get("package2")
+        if not binary2 and not package2:
+            binary2, package2 = binary, package
+        for path in (binary, package, binary2, package2):
+            if path and (not isinstance(path, basestring) or not os.path.isfile(path)):
+                raise ValueError("%s does not exist" % path)
+        sessions = int_option(request.get("sessions", 1))
+        if not 1 <= sessions <= len(self.sessions):
+            raise ValueError("Can run on 1 to %d sessions, not %d" % (len(self.sessions), sessions))
+        if not isinstance(request.get("options", {}), dict):
+            raise ValueError("options must be an object")
+        options = {}
+        for name, value in request.get("options", {}).iteritems():
+            if name not in RUN_OPTIONS:
+                raise ValueError("Unknown option %s" % name)
+            try:
+                options[name] = RUN_OPTIONS[name](value)
+            except ValueError as e:
+                raise ValueError("Option %s: %s" % (name, e))
+        tests = read_manifest(manifest)["tests"]
+        with self.condition:
+            run = Run(self.next_id, manifest, tests, (binary, package, binary2, package2),
+                      sessions, options)
+            self.next_id += 1
+            self.runs[run.id] = run
+            self.queue.append(run)
+            self.condition.notify_all()
+        self.log.info("Queued run %d of %s", run.id, manifest)
+        return run
+
+    def schedule(self):
+        """Start the first queued run whenever enough sessions are free."""
+        threads = []
+        while True:
+            with self.condition:
+                while not self.stopping and not (
+                    self.queue and len(self.free) >= self.queue[0].sessions):
+                    self.condition.wait()
+                if self.stopping:
+                    break
+                run = self.queue.pop(0)
+                sessions = self.free[:run.sessions]
+                del self.free[:run.sessions]
+            t = threading.Thread(target=self.execute, args=(run, sessions),
+                                 name="run%d" % run.id)
+            t.start()
+            threads.append(t)
+            threads = [t for t in threads if t.is_alive()]
+        for t in threads:
+            t.join()
+
+    def execute(self, run, sessions):
+        run.set_state("running")
+        self.log.info("Starting run %d on %s", run.id,
+                      ", ".join(info['name'] for session in sessions for info in session))
+        prefix = "/runs/%d/" % run.id
+        error = None
+        db = None
+        try:
+            options = copy.copy(self.options)
+            options.html_manifest = run.manifest
+            for name, value in run.options.iteritems():
+                setattr(options, name, value)
+            if self.options.log_dest:
+                options.log_dest = os.path.join(self.options.log_dest, "run-%d" % run.id)
+                os.mkdir(options.log_dest)
+            if options.results_db:
+                db = ResultsDatabase(options.results_db)
+            run.tests, durations = select_tests(run.tests, db, options, self.log)
+            if run.tests:
+                error = self.setup(run, sessions, options)
+            if run.tests and not error:
+                self.static.add_directory(prefix + "tests", os.path.dirname(run.manifest))
+                results = run_with_retries(self.httpd, self.static, run.tests, sessions,
+                                           durations, self.log, options, db=db, prefix=prefix,
+                                           on_record=run.add_record, relay=self.relay)
+                with run.condition:
+                    run.errors = results.errors()
+                    run.merged = results.merged()
+                # The relay is shared by all runs, its latency isn't this run's.
+                report_timing(results, self.log, options)
+                run.stats.report(self.log, options.log_dest)
+                # The samples are only needed for the report.
+                run.stats = None
+                report_results(run.merged, self.log, options, run.errors)
+        except Exception as e:
+            error = "Error running tests: %s" % e
+        finally:
+            if db:
+                db.close()
+            self.static.remove(prefix)
+            with self.condition:
+                self.free.extend(sessions)
+                self.condition.notify_all()
+        if error:
+            self.log.error("Run %d failed: %s", run.id, error)
+        run.set_state("finished", error)
+        self.prune_runs()
+        # Each test counts once, as failed if it failed on any client.
+        counts = summary(run.merged or [], run.errors)
+        self.log.info("Finished run %d: %d passed, %d failed, %d errors outside of tests",
+                      run.id, counts["pass"], counts["fail"], counts["errors"])
+
+    def prune_runs(self):
+        """Forget the oldest finished runs beyond MAX_FINISHED_RUNS, the
+        daemon would grow for as long as it runs otherwise."""
+        with self.condition:
+            finished = [id for id in sorted(self.runs) if self.runs[id].state == "finished"]
+            for id in finished[:-MAX_FINISHED_RUNS]:
+                del self.runs[id]
+
+    def setup(self, run, sessions, options):
+        """Set up the build of |run| on the clients of |sessions| that don't
+        have it from their last run. Return an error message or None."""
+        binary, package, binary2, package2 = run.builds
+        stale = []
+        for session in sessions:
+            for info in session:
+                info['binary'] = binary if info['index'] == 0 else binary2
+                info['package'] = package if info['index'] == 0 else package2
+                key = build_key(info)
+                if info.get('build') != key:
+                    info['build'] = None
+                    stale.append((info, key))
+        errors = setup_clients([info for info, key in stale], self.log, options)
+        for info, key in stale:
+            if info['name'] not in errors:
+                info['build'] = key
+        if errors:
+            return "; ".join("%s: %s" % (name, errors[name]) for name in sorted(errors))
+        return None
+
+    def status(self):
+        with self.condition:
+            return {"sessions": [[info['name'] for info in session] for session in self.sessions],
+                    "free": [[info['name'] for info in session] for session in self.free],
+                    "queued": [run.id for run in self.queue]}
+
+    def stats_urlhandlers(self):
+        """Return the MozHttpd urlhandlers receiving the statistics the
+        clients post to the prefix of their run."""
+        @json_response
+        def post_stats(req, id):
+            run = self.runs.get(int(id))
+            stats = run.stats if run else None
+            if stats is None:
+                return (404, {})
+            return stats.post(req.body)
+
+        return [{'method': 'POST',
+                 'path': r'/runs/(\d+)/stats$',
+                 'function': post_stats}]
+
+    def urlhandlers(self):
+        """Return the MozHttpd urlhandlers of the API."""
+        @json_response
+        def post_run(req):
+            try:
+                run = self.submit(json.loads(req.body or "{}"))
+            except ValueError as e:
+                return (400, {"error": str(e)})
+            return (200, run.to_dict())
+
+        @json_response
+        def get_runs(req):
+            with self.condition:
+                runs = [self.runs[id] for id in sorted(self.runs)]
+            return (200, {"runs": [run.to_dict() for run in runs]})
+
+        @json_response
+        def get_run(req, id):
+            run = self.runs.get(int(id))
+            if not run:
+                return (404, {"error": "No run %s" % id})
+            query = parse_qs(req.query)
+            since = int(query.get("since", [0])[0])
+            wait = min(float(query.get("wait", [0])[0]), MAX_WAIT)
+            if wait > 0:
+                run.wait(since, wait)
+            return (200, run.to_dict(since))
+
+        @json_response
+        def get_status(req):
+            return (200, self.status())
+
+        return [{'method': 'POST',
+                 'path': '/api/runs$',
+                 'function': post_run},
+                {'method': 'GET',
+                 'path': '/api/runs$',
+                 'function': get_runs},
+                {'method': 'GET',
+                 'path': r'/api/runs/(\d+)$',
+                 'function': get_run},
+                {'method': 'GET',
+                 'path': '/api/status$',
+                 'function': get_status}]
+
+def main(args):
+    parser = DaemonOptions()
+    options, args = parser.parse_args(args)
+    have_hosts = options.hosts or options.hosts_file or (options.host1 and options.host2) or options.local
+    have_signalling = options.signalling_server or options.builtin_signalling
+    if not options.specialpowers or not have_hosts or not have_signalling:
+        parser.print_usage()
+        return 2
+    if not os.path.isdir(options.specialpowers):
+        parser.error("SpecialPowers directory %s does not exist" % options.specialpowers)
+        return 2
+    if options.prefs and not os.path.isfile(options.prefs):
+        parser.error("Prefs file %s does not exist" % options.prefs)
+        return 2
+    if options.log_dest and not os.path.isdir(options.log_dest):
+        parser.error("Log directory %s does not exist" % options.log_dest)
+        return 2
+    for name in PER_RUN_OPTIONS:
+        if getattr(options, name):
+            parser.error("--%s can't be used with the daemon" % name.replace("_", "-"))
+            return 2
+    if options.rerun_failures and not options.results_db:
+        parser.error("--rerun-failures needs --results-db")
+        return 2
+    if (options.profile or options.cprofile) and not options.log_dest:
+        parser.error("--profile and --cprofile need --save-logs-to")
+        return 2
+    hosts = read_hosts(options)
+    if not hosts or len(hosts) % options.session_size:
+        parser.error("Need a multiple of %d hosts, got %d" % (options.session_size, len(hosts)))
+        return 2
+
+    log = mozlog.getLogger('steeplechase')
+    log.setLevel(mozlog.DEBUG)
+    daemon = Daemon(options, hosts, log)
+    daemon.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        log.info("Waiting for running tests to finish...")
+    finally:
+        daemon.stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
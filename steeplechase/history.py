@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    passes INTEGER NOT NULL,
+    failures INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    path TEXT NOT NULL,
+    client TEXT NOT NULL,
+    status TEXT,
+    passes INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS results_run ON results(run_id);
+"""
+
+class ResultsDatabase(object):
+    """SQLite database of the outcome and duration of every test on every
+    client in earlier runs. A run is either the first pass over the
+    manifest ("run"), a run of the tests that failed in the last one
+    ("rerun") or a retry of the tests that failed in either ("retry")."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def record_run(self, results, kind, started):
+        """Store the ResultSet |results| of a run of |kind| that started at
+        |started|."""
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (kind, started, finished, passes, failures) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (kind, started, time.time(), results.passes, results.failures))
+            run_id = cursor.lastrowid
+            self.conn.executemany(
+                "INSERT INTO results (run_id, path, client, status, passes, failures, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, t.path, t.client, t.status, t.passes, t.failures, t.duration())
+                 for t in results.tests.itervalues()])
+
+    def recent_runs(self, count):
+        """Return the ids of the last |count| runs of any kind."""
+        rows = self.conn.execute("SELECT id FROM runs ORDER BY id DESC LIMIT ?", (count,))
+        return [row[0] for row in rows]
+
+    def durations(self, runs=5):
+        """Return a dict mapping test paths to their average duration in
+        seconds over the last |runs| runs, taking the slowest client."""
+        ids = self.recent_runs(runs)
+        if not ids:
+            return {}
+        rows = self.conn.execute(
+            "SELECT path, AVG(duration) FROM "
+            "(SELECT run_id, path, MAX(duration) AS duration FROM results "
+            " WHERE duration IS NOT NULL AND run_id IN (%s) GROUP BY run_id, path) "
+            "GROUP BY path" % ",".join("?" * len(ids)), ids)
+        return dict(rows)
+
+    def recent_failures(self, runs=10):
+        """Return a dict mapping the paths of the tests that failed or didn't
+        finish in the last |runs| runs to the id of the last run they failed
+        in."""
+        ids = self.recent_runs(runs)
+        if not ids:
+            return {}
+        rows = self.conn.execute(
+            "SELECT path, MAX(run_id) FROM results "
+            "WHERE (failures > 0 OR status IS NULL) AND run_id IN (%s) "
+            "GROUP BY path" % ",".join("?" * len(ids)), ids)
+        return dict(rows)
+
+    def last_failures(self):
+        """Return the set of paths of the tests that failed in the last
+        first pass over a manifest, or None if there was none."""
+        row = self.conn.execute(
+            "SELECT id FROM runs WHERE kind = 'run' ORDER BY id DESC LIMIT 1").fetchone()
+        if not row:
+            return None
+        rows = self.conn.execute(
+            "SELECT DISTINCT path FROM results "
+            "WHERE run_id = ? AND (failures > 0 OR status IS NULL)", row)
+        return set(r[0] for r in rows)
+
+def failures_first(tests, failures):
+    """Return the manifest entries |tests| with the ones in |failures|, a dict
+    from recent_failures, first. The most recently failed come first, the
+    others keep their order."""
+    failed = [t for t in tests if t["path"] in failures]
+    failed.sort(key=lambda t: -failures[t["path"]])
+    return failed + [t for t in tests if t["path"] not in failures]
@@ -0,0 +1,118 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from distutils.dir_util import copy_tree
+from mozdevice import DMError
+from mozprofile import Profile
+from mozrunner import FirefoxRunner
+
+import mozfile
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+# The host name of clients run by LocalDevice.
+LOCAL_HOST = "local"
+
+class LocalDevice(object):
+    """Runs a client on the controller itself. It implements the part of
+    the DeviceManager interface steeplechase uses on the local file system,
+    so no agent is needed, and starts the browser with mozrunner."""
+
+    def __init__(self, root=None):
+        self.root = root or os.path.join(tempfile.gettempdir(), "steeplechase-local")
+        self.runners = []
+        self.lock = threading.Lock()
+
+    def getDeviceRoot(self):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        return self.root
+
+    def fileExists(self, path):
+        return os.path.exists(path)
+
+    def dirExists(self, path):
+        return os.path.isdir(path)
+
+    def mkDir(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def removeDir(self, path):
+        mozfile.remove(path)
+
+    def removeFile(self, path):
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def listFiles(self, path):
+        if not os.path.isdir(path):
+            return []
+        return os.listdir(path)
+
+    def pushFile(self, local_path, path):
+        self.mkDir(os.path.dirname(path))
+        shutil.copy2(local_path, path)
+
+    def pushDir(self, local_dir, path):
+        copy_tree(local_dir, path, preserve_symlinks=True)
+
+    def copyTree(self, source, destination):
+        if os.path.isdir(source):
+            shutil.copytree(source, destination)
+        else:
+            shutil.copy2(source, destination)
+
+    def pullFile(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def getFile(self, path, local_path):
+        shutil.copyfile(path, local_path)
+
+    def shellCheckOutput(self, cmd, env=None, cwd=None):
+        """Run |cmd| like DeviceManagerSUT does, joined by spaces in a shell,
+        and return its output. Raises DMError if it fails."""
+        full_env = dict(os.environ)
+        full_env.update(env or {})
+        process = subprocess.Popen(" ".join(cmd), shell=True, cwd=cwd, env=full_env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0].rstrip()
+        if process.returncode != 0:
+            raise DMError("Non-zero return code for command: %s (output: '%s', retval: '%s')" %
+                          (cmd, output, process.returncode))
+        return output
+
+    def runApplication(self, binary, profile_path, args, env, output):
+        """Run the browser at |binary| with the profile at |profile_path|
+        and command line |args| until it exits. Each line it prints is
+        written to |output|. Returns its exit code."""
+        full_env = dict(os.environ)
+        full_env.update(env)
+        runner = FirefoxRunner(binary=binary,
+                               cmdargs=args,
+                               env=full_env,
+                               profile=Profile(profile=profile_path, restore=False),
+                               clean_profile=False,
+                               process_args={'processOutputLine': [lambda line: output.write(line + '\n')],
+                                             'stream': None,
+                                             'storeOutput': False})
+        with self.lock:
+            self.runners.append(runner)
+        try:
+            runner.start()
+            return runner.wait()
+        finally:
+            with self.lock:
+                self.runners.remove(runner)
+
+    def killProcess(self, appname, sig=None):
+        """Kill the browsers at |appname| that this device started."""
+        with self.lock:
+            runners = [r for r in self.runners if r.binary == appname]
+        for runner in runners:
+            runner.stop(sig)
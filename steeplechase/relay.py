@@ -0,0 +1,198 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+from mozhttpd.handlers import json_response
+from urlparse import parse_qs
+
+import threading
+import time
+
+# Seconds a poll waits for events before returning none.
+POLL_TIMEOUT = 25
+# The number of recent delivery and round trip times the latency summary
+# is computed from, a long-lived relay would keep all of them otherwise.
+MAX_LATENCY_SAMPLES = 10000
+
+class Room(object):
+    """Clients of one signalling room and the events waiting for them."""
+
+    def __init__(self):
+        self.clients = {}
+        self.next_client = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def join(self):
+        with self.condition:
+            client = self.next_client
+            self.next_client += 1
+            for events in self.clients.itervalues():
+                events.append({"event": "client_joined"})
+            self.clients[client] = []
+            self.condition.notify_all()
+            return client, len(self.clients)
+
+    def send(self, sender, data):
+        """Queue |data| for all clients except |sender|."""
+        with self.condition:
+            now = time.time()
+            for client, events in self.clients.iteritems():
+                if client != sender:
+                    events.append({"event": "message", "data": data, "queued": now})
+            self.condition.notify_all()
+
+    def poll(self, client, timeout):
+        """Return the events for |client|, waiting up to |timeout| seconds
+        for one to arrive or the client to leave."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while (client in self.clients and not self.clients[client] and
+                   not self.closed and time.time() < deadline):
+                self.condition.wait(deadline - time.time())
+            if client not in self.clients:
+                return []
+            events = self.clients[client]
+            self.clients[client] = []
+            return events
+
+    def leave(self, client):
+        """Remove |client| and return True if no clients are left."""
+        with self.condition:
+            self.clients.pop(client, None)
+            self.condition.notify_all()
+            return not self.clients
+
+    def close(self):
+        """Wake up all waiting polls."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class SignallingRelay(object):
+    """A long-poll signalling relay served by the controller's MozHttpd,
+    a replacement for an external socket.io signalling server. Clients
+    join a room, post messages to it, poll for the messages of the other
+    clients in it and leave it when they are done. Any number of rooms can
+    be used at the same time.
+
+    The relay records how long messages wait for the receiving client and
+    the round trip times the clients measure for their requests."""
+
+    def __init__(self, poll_timeout=POLL_TIMEOUT):
+        self.poll_timeout = poll_timeout
+        # Rooms are dropped when their clients leave or the run ends.
+        self.rooms = {}
+        self.room_count = 0
+        self.lock = threading.Lock()
+        self.message_count = 0
+        self.delivery_times = deque(maxlen=MAX_LATENCY_SAMPLES)
+        self.round_trip_times = deque(maxlen=MAX_LATENCY_SAMPLES)
+
+    def room(self, name, create=False):
+        """Return the room |name|, or None if it doesn't exist and |create|
+        isn't set."""
+        with self.lock:
+            if name not in self.rooms:
+                if not create:
+                    return None
+                self.rooms[name] = Room()
+                self.room_count += 1
+            return self.rooms[name]
+
+    def leave(self, name, client):
+        """Remove |client| from the room |name|, and the room once all of
+        its clients left."""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room and room.leave(client):
+                room.close()
+                del self.rooms[name]
+
+    def remove(self, name):
+        """Remove the room |name| when the run that used it ended. Clients
+        that were killed never leave it."""
+        with self.lock:
+            room = self.rooms.pop(name, None)
+        if room:
+            room.close()
+
+    def urlhandlers(self, prefix="/relay/"):
+        """Return the MozHttpd urlhandlers of the relay under |prefix|."""
+        @json_response
+        def join(req, room):
+            client, count = self.room(room, create=True).join()
+            return (200, {"client": client, "clients": count})
+
+        @json_response
+        def send(req, room):
+            query = parse_qs(req.query)
+            client = int(query["client"][0])
+            if "rtt" in query:
+                with self.lock:
+                    self.round_trip_times.append(float(query["rtt"][0]) / 1000)
+            room = self.room(room)
+            if not room:
+                return (404, {})
+            room.send(client, req.body)
+            return (200, {})
+
+        @json_response
+        def poll(req, room):
+            client = int(parse_qs(req.query)["client"][0])
+            room = self.room(room)
+            if not room or client not in room.clients:
+                return (404, {})
+            events = room.poll(client, self.poll_timeout)
+            now = time.time()
+            with self.lock:
+                for event in events:
+                    if "queued" in event:
+                        self.message_count += 1
+                        self.delivery_times.append(now - event.pop("queued"))
+            return (200, {"events": events})
+
+        @json_response
+        def leave(req, room):
+            self.leave(room, int(parse_qs(req.query)["client"][0]))
+            return (200, {})
+
+        room = r'([\w-]+)'
+        return [{'method': 'POST',
+                 'path': prefix + room + '/join$',
+                 'function': join},
+                {'method': 'POST',
+                 'path': prefix + room + '/leave$',
+                 'function': leave},
+                {'method': 'POST',
+                 'path': prefix + room + '/send$',
+                 'function': send},
+                {'method': 'GET',
+                 'path': prefix + room + '/poll$',
+                 'function': poll}]
+
+    def close(self):
+        """Return from all waiting polls, so the server can stop."""
+        with self.lock:
+            for room in self.rooms.itervalues():
+                room.close()
+
+    def latency_summary(self):
+        """Return the message delivery and client round trip times as a
+        dict that can be written as JSON. Times are in seconds, of the last
+        MAX_LATENCY_SAMPLES messages and requests."""
+        with self.lock:
+            summary = {"rooms": self.room_count,
+                       "messages": self.message_count}
+            for name, times in (("delivery", self.delivery_times),
+                                ("round_trip", self.round_trip_times)):
+                if times:
+                    summary[name] = {"median": percentile(times, 0.5),
+                                     "p95": percentile(times, 0.95),
+                                     "max": max(times)}
+        return summary
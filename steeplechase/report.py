@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from xml.etree import ElementTree
+
+import json
+import re
+
+# Characters that can't appear in XML, browser output has some.
+_invalid_xml = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _text(line):
+    """Return a line of client output, which may not be valid UTF-8, as
+    unicode."""
+    if isinstance(line, str):
+        return line.decode("utf-8", "replace")
+    return line
+
+def summary(merged, errors=()):
+    """Return the number of tests by outcome, the number of checks that
+    passed and failed on all clients and the number of |errors| outside of
+    tests, for a list of MergedResults."""
+    counts = {"tests": len(merged), "pass": 0, "fail": 0, "empty": 0,
+              "passes": 0, "failures": 0, "errors": len(errors)}
+    for test in merged:
+        counts[test.outcome] += 1
+        counts["passes"] += test.passes
+        counts["failures"] += test.failures
+    return counts
+
+def failure_text(test):
+    """Return the failures of the MergedResult |test| on each client with
+    the output around them, as lines of text."""
+    lines = []
+    for client, result in test.clients.iteritems():
+        lines.append("%s: %d failed, %d passed, %s" % (
+            client, result.failures, result.passes, result.status or "did not finish"))
+        for record in result.failure_records:
+            lines.append("    %s" % record.message)
+            for line in record.log or []:
+                lines.append(u"      | %s" % _text(line))
+    return lines
+
+def error_text(errors):
+    """Return the (client, TestFailure) pairs of |errors| outside of tests
+    with the output around them, as lines of text."""
+    lines = []
+    for client, record in errors:
+        lines.append("%s: %s" % (client, record.message))
+        for line in record.log or []:
+            lines.append(u"    | %s" % _text(line))
+    return lines
+
+def text_report(merged, errors=()):
+    """Return a report of a list of MergedResults and the |errors| outside
+    of tests as lines of text. Only failed tests are shown in detail."""
+    counts = summary(merged, errors)
+    lines = ["%d tests: %d passed, %d failed, %d without checks "
+             "(%d checks passed, %d failed)" % (
+             counts["tests"], counts["pass"], counts["fail"], counts["empty"],
+             counts["passes"], counts["failures"])]
+    if errors:
+        lines.append("%d errors outside of tests:" % len(errors))
+        lines.extend("  " + line for line in error_text(errors))
+    for test in merged:
+        if test.outcome != "fail":
+            continue
+        duration = test.duration()
+        lines.append("FAIL %s%s" % (test.path,
+                                     " (%.2fs)" % duration if duration is not None else ""))
+        lines.extend("  " + line for line in failure_text(test))
+    return lines
+
+def errors_to_dict(errors):
+    """Return the (client, TestFailure) pairs of |errors| outside of tests
+    as dicts for the JSON report."""
+    return [{"client": client, "message": record.message, "source_file": record.source_file}
+            for client, record in errors]
+
+def write_json(merged, path, errors=()):
+    with open(path, "w") as f:
+        json.dump({"summary": summary(merged, errors),
+                   "tests": [test.to_dict() for test in merged],
+                   "errors": errors_to_dict(errors)},
+                  f, indent=2, sort_keys=True)
+
+def write_xunit(merged, path, name="steeplechase", errors=()):
+    """Write a list of MergedResults as an xUnit XML file to |path|, one
+    testcase per test. The |errors| outside of tests are counted as errors
+    of the suite and listed in its system-err."""
+    counts = summary(merged, errors)
+    suite = ElementTree.Element("testsuite", name=name, tests=str(counts["tests"]),
+                                failures=str(counts["fail"]), errors=str(counts["errors"]),
+                                skipped="0",
+                                time="%.3f" % sum(test.duration() or 0 for test in merged))
+    for test in merged:
+        case = ElementTree.SubElement(suite, "testcase", classname=name, name=test.path,
+                                      time="%.3f" % (test.duration() or 0))
+        if test.outcome == "fail":
+            messages = ["%s: %s" % (client, r.message)
+                        for client, result in test.clients.iteritems()
+                        for r in result.failure_records]
+            messages += ["%s: did not finish" % client
+                         for client, result in test.clients.iteritems() if result.status is None]
+            failure = ElementTree.SubElement(case, "failure",
+                                             message=_invalid_xml.sub("?", messages[0]))
+            failure.text = _invalid_xml.sub("?", "\n".join(failure_text(test)))
+    if errors:
+        system_err = ElementTree.SubElement(suite, "system-err")
+        system_err.text = _invalid_xml.sub("?", "\n".join(error_text(errors)))
+    ElementTree.ElementTree(suite).write(path, encoding="utf-8")
@@ -0,0 +1,357 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+
+import json
+import time
+
+class LogRecord(object):
+    """A structured record logged by the harness. |data| holds all of its
+    fields, the common ones are attributes too."""
+
+    __slots__ = ("data", "action", "source_file", "message", "time")
+
+    def __init__(self, data):
+        self.data = data
+        self.action = data["action"]
+        self.source_file = data.get("source_file")
+        self.message = data.get("message")
+        self.time = data.get("time")
+
+class TestStart(LogRecord):
+    __slots__ = ("index", "timeout")
+
+    def __init__(self, data):
+        LogRecord.__init__(self, data)
+        self.index = data.get("index")
+        self.timeout = data.get("timeout")
+
+class TestPass(LogRecord):
+    __slots__ = ()
+
+class TestFailure(LogRecord):
+    # The lines of output around the failure, if they were kept.
+    __slots__ = ("log",)
+
+    def __init__(self, data):
+        LogRecord.__init__(self, data)
+        self.log = None
+
+class TestEnd(LogRecord):
+    __slots__ = ("index", "status", "load_time", "handshake_time", "run_time")
+
+    def __init__(self, data):
+        LogRecord.__init__(self, data)
+        self.index = data.get("index")
+        self.status = data.get("status")
+        self.load_time = data.get("load_time")
+        self.handshake_time = data.get("handshake_time")
+        self.run_time = data.get("run_time")
+
+record_types = {"test_start": TestStart,
+                "test_pass": TestPass,
+                "test_unexpected_fail": TestFailure,
+                "test_end": TestEnd}
+
+_decode = json.JSONDecoder().decode
+
+# The paths failures outside of any test are logged under, by the
+# controller and by the harness.
+NON_TEST_PATHS = ("steeplechase", "harness.js", None)
+
+def parse_record(line):
+    """Return the LogRecord logged on |line| by the harness, or None if
+    |line| isn't one. Most lines are plain browser output, they are
+    rejected without parsing them."""
+    if not line.startswith('{'):
+        return None
+    line = line.rstrip('\r')
+    if not line.endswith('}') or '"action"' not in line:
+        return None
+    try:
+        data = _decode(line)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or "action" not in data:
+        return None
+    return record_types.get(data["action"], LogRecord)(data)
+
+def failure(message, source_file="steeplechase"):
+    """Return a TestFailure for an error that is not reported by the harness."""
+    return TestFailure({"action": "test_unexpected_fail",
+                        "message": message,
+                        "time": int(time.time() * 1000),
+                        "source_file": source_file})
+
+class StructuredLogParser(object):
+    """Incremental parser for the output of a client. Feed it chunks of
+    output as they arrive, or a saved log, and it returns the LogRecords
+    of the complete lines so far. |partial| holds the incomplete last line."""
+
+    def __init__(self):
+        self.partial = ""
+
+    def lines(self, data):
+        """Return the lines completed by |data|."""
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return lines
+
+    def parse(self, data):
+        """Return the lines completed by |data|, each with the LogRecord
+        logged on it or None."""
+        return [(line, parse_record(line)) for line in self.lines(data)]
+
+    def feed(self, data):
+        """Return the LogRecords of the lines completed by |data|."""
+        return [record for line, record in self.parse(data) if record]
+
+    def finish(self):
+        """Return the incomplete last line, if any, like parse does."""
+        line, self.partial = self.partial, ""
+        return [(line, parse_record(line))] if line else []
+
+    def close(self):
+        """Return the LogRecord of the incomplete last line, if any."""
+        return [record for line, record in self.finish() if record]
+
+def read_log(path, client, chunk_size=1024 * 1024):
+    """Return the ResultSet of a log saved from the output of |client|."""
+    parser = StructuredLogParser()
+    results = ResultSet()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            for record in parser.feed(data):
+                results.add(client, record)
+    for record in parser.close():
+        results.add(client, record)
+    return results
+
+class TestResult(object):
+    """Outcome and timing of a single test on a single client. Times are
+    in seconds."""
+
+    def __init__(self, path, client):
+        self.path = path
+        self.client = client
+        self.passes = 0
+        self.failures = 0
+        # The TestFailures of this test.
+        self.failure_records = []
+        self.status = None
+        self.start_time = None
+        self.end_time = None
+        self.load_time = None
+        self.handshake_time = None
+        self.run_time = None
+
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def update(self, other):
+        """Add the results of |other|, a later result of the same test on
+        the same client."""
+        self.passes += other.passes
+        self.failures += other.failures
+        self.failure_records.extend(other.failure_records)
+        for attr in ("status", "start_time", "end_time", "load_time",
+                     "handshake_time", "run_time"):
+            if getattr(other, attr) is not None:
+                setattr(self, attr, getattr(other, attr))
+
+    def to_dict(self):
+        return {"path": self.path,
+                "client": self.client,
+                "passes": self.passes,
+                "failures": self.failures,
+                "status": self.status,
+                "failure_messages": [r.message for r in self.failure_records],
+                "duration": self.duration(),
+                "load_time": self.load_time,
+                "handshake_time": self.handshake_time,
+                "run_time": self.run_time}
+
+class MergedResult(object):
+    """The outcome of a test over all clients that ran it, keeping the
+    TestResult of each client."""
+
+    def __init__(self, path):
+        self.path = path
+        # TestResults by client.
+        self.clients = OrderedDict()
+
+    @property
+    def passes(self):
+        return sum(t.passes for t in self.clients.itervalues())
+
+    @property
+    def failures(self):
+        return sum(t.failures for t in self.clients.itervalues())
+
+    @property
+    def outcome(self):
+        """"fail" if the test failed or didn't finish on any client, "pass"
+        if it passed somewhere and failed nowhere, "empty" if it checked
+        nothing."""
+        if self.failures or any(t.status is None for t in self.clients.itervalues()):
+            return "fail"
+        if self.passes:
+            return "pass"
+        return "empty"
+
+    def duration(self):
+        """Return the longest time the test took on any client."""
+        durations = [t.duration() for t in self.clients.itervalues()
+                     if t.duration() is not None]
+        return max(durations) if durations else None
+
+    def to_dict(self):
+        return {"path": self.path,
+                "outcome": self.outcome,
+                "duration": self.duration(),
+                "clients": dict((client, {"passes": t.passes,
+                                          "failures": t.failures,
+                                          "status": t.status,
+                                          "failure_messages": [r.message for r in t.failure_records]})
+                                for client, t in self.clients.iteritems())}
+
+def _seconds(ms):
+    if ms is None:
+        return None
+    return ms / 1000.0
+
+class ResultSet(object):
+    """Results of tests on any number of clients, built from the structured
+    results logged by the harness."""
+
+    def __init__(self):
+        self.tests = OrderedDict()
+        # The clients each test was meant to run on, by path.
+        self.expected = OrderedDict()
+        self.passes = 0
+        self.failures = 0
+
+    def expect(self, path, clients):
+        """Note that |path| was meant to run on |clients|. It fails if it
+        is missing on any of them."""
+        self.expected[path] = list(clients)
+
+    def get(self, path, client):
+        """Return the TestResult of |path| on |client|, creating it if needed."""
+        key = (path, client)
+        if key not in self.tests:
+            self.tests[key] = TestResult(path, client)
+        return self.tests[key]
+
+    def add(self, client, record):
+        """Add a LogRecord logged on |client|."""
+        test = self.get(record.source_file, client)
+        if isinstance(record, TestPass):
+            test.passes += 1
+            self.passes += 1
+        elif isinstance(record, TestFailure):
+            test.failures += 1
+            test.failure_records.append(record)
+            self.failures += 1
+        elif isinstance(record, TestStart):
+            test.start_time = _seconds(record.time)
+        elif isinstance(record, TestEnd):
+            test.status = record.status
+            test.end_time = _seconds(record.time)
+            test.load_time = _seconds(record.load_time)
+            test.handshake_time = _seconds(record.handshake_time)
+            test.run_time = _seconds(record.run_time)
+
+    def update(self, other):
+        """Add all results of the ResultSet |other|."""
+        for key, test in other.tests.iteritems():
+            if key in self.tests:
+                self.tests[key].update(test)
+            else:
+                self.tests[key] = test
+        self.expected.update(other.expected)
+        self.passes += other.passes
+        self.failures += other.failures
+
+    def merged(self):
+        """Return a MergedResult for each test path, in the order they
+        first ran. A test that is missing on a client it was meant to run
+        on has an empty TestResult there. Failures outside of tests are
+        left out, see errors."""
+        merged = OrderedDict()
+        for test in self.tests.itervalues():
+            if test.path in NON_TEST_PATHS:
+                continue
+            if test.path not in merged:
+                merged[test.path] = MergedResult(test.path)
+            merged[test.path].clients[test.client] = test
+        for path, clients in self.expected.iteritems():
+            if path not in merged:
+                merged[path] = MergedResult(path)
+            for client in clients:
+                if client not in merged[path].clients:
+                    merged[path].clients[client] = TestResult(path, client)
+        return merged.values()
+
+    def errors(self):
+        """Return the failures logged outside of any test, like harness
+        errors and crashed browsers, as a list of (client, TestFailure)."""
+        return [(test.client, record) for test in self.tests.itervalues()
+                if test.path in NON_TEST_PATHS for record in test.failure_records]
+
+    def failed(self, path):
+        """Return True if |path| failed or didn't finish on any client, like
+        the outcome of its MergedResult."""
+        tests = [t for t in self.tests.itervalues() if t.path == path]
+        ran_on = set(t.client for t in tests)
+        return (any(t.failures or t.status is None for t in tests) or
+                any(client not in ran_on for client in self.expected.get(path, [])))
+
+    def without(self, paths):
+        """Return a ResultSet of all tests except those in |paths|."""
+        paths = set(paths)
+        results = ResultSet()
+        for key, test in self.tests.iteritems():
+            if test.path not in paths:
+                results.tests[key] = test
+                results.passes += test.passes
+                results.failures += test.failures
+        for path, clients in self.expected.iteritems():
+            if path not in paths:
+                results.expected[path] = clients
+        return results
+
+    def durations(self):
+        """Return a dict mapping test paths to the longest time they took
+        on any client."""
+        durations = {}
+        for test in self.tests.itervalues():
+            duration = test.duration()
+            if duration is not None:
+                durations[test.path] = max(duration, durations.get(test.path, 0))
+        return durations
+
+    def slowest(self, count):
+        """Return the |count| TestResults that took longest."""
+        timed = [t for t in self.tests.itervalues() if t.duration() is not None]
+        return sorted(timed, key=lambda t: -t.duration())[:count]
+
+    def skews(self, count):
+        """Return the |count| tests whose duration differs most between
+        clients, as a list of (path, difference in seconds)."""
+        by_path = {}
+        for test in self.tests.itervalues():
+            if test.duration() is not None:
+                by_path.setdefault(test.path, []).append(test.duration())
+        skews = [(path, max(d) - min(d)) for path, d in by_path.iteritems() if len(d) > 1]
+        return sorted(skews, key=lambda skew: -skew[1])[:count]
+
+    def timing_report(self):
+        """Return the timing of all tests as a dict that can be written as
+        JSON. Its "durations" can be passed to --test-durations."""
+        return {"tests": [t.to_dict() for t in self.tests.itervalues()],
+                "durations": self.durations()}
@@ -6,11 +6,27 @@ from manifestparser import TestManifest
 from mozdevice import DeviceManagerSUT, DMError
 from optparse import OptionParser
 from mozprofile import FirefoxProfile, Profile, Preferences
-from mozprofile.permissions import ServerLocations
+from mozprofile.permissions import Permissions, ServerLocations
 from mozhttpd import MozHttpd
-from mozhttpd.handlers import json_response
-from Queue import Queue
-
+from relay import SignallingRelay
+from report import text_report, write_json, write_xunit
+from results import (ResultSet, StructuredLogParser, TestEnd, TestFailure, TestPass, TestStart,
+                     failure, read_log)
+from static import StaticFiles
+from stats import StatsCollector
+from Queue import Queue, Empty
+from StringIO import StringIO
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from functools import partial
+from history import ResultsDatabase, failures_first
+from localdevice import LocalDevice, LOCAL_HOST
+
+import bz2
+import cProfile
+import gzip
+import hashlib
 import json
 import mozfile
 import mozinfo
@@ -18,8 +34,13 @@ import mozlog
 import moznetwork
 import os
 import re
+import shutil
+import subprocess
 import sys
+import tarfile
+import tempfile
 import threading
+import time
 import uuid
 import posixpath
 
@@ -57,9 +78,44 @@ class Options(OptionParser):
         self.add_option("--host2",
                         action="store", type="string", dest="host2",
                         help="first remote host to run tests on")
+        self.add_option("--hosts",
+                        action="store", type="string", dest="hosts",
+                        help="comma-separated pool of remote hosts to run tests on, "
+                             "used in sessions of SESSION_SIZE instead of --host1 and --host2")
+        self.add_option("--hosts-file",
+                        action="store", type="string", dest="hosts_file",
+                        help="file listing a pool of remote hosts, one per line")
+        self.add_option("--test-durations",
+                        action="store", type="string", dest="test_durations",
+                        help="JSON file mapping test paths to durations in seconds, "
+                             "used to balance tests between sessions")
+        self.add_option("--session-size",
+                        action="store", type="int", dest="session_size",
+                        default=2,
+                        help="number of clients that run each test together. The first "
+                             "client of a session uses BINARY, the others BINARY2")
+        self.add_option("--roles",
+                        action="store", type="string", dest="roles",
+                        help="comma-separated roles of the clients of a session, passed "
+                             "to the tests. Defaults to initiator for the first client "
+                             "and responder for the others")
         self.add_option("--signalling-server",
                         action="store", type="string", dest="signalling_server",
                         help="signalling server URL to use for tests")
+        self.add_option("--no-request-log",
+                        action="store_false", dest="log_requests",
+                        default=True,
+                        help="do not keep a log of all requests to the web server")
+        self.add_option("--local",
+                        action="store_true", dest="local",
+                        default=False,
+                        help="run both clients on this machine without Negatus, using "
+                             "BINARY in place. Hosts named \"%s\" are local clients too" % LOCAL_HOST)
+        self.add_option("--builtin-signalling",
+                        action="store_true", dest="builtin_signalling",
+                        default=False,
+                        help="relay signalling messages through the controller's "
+                             "web server instead of a signalling server")
         self.add_option("--noSetup",
                         action="store_false", dest="setup",
                         default="True",
@@ -73,52 +129,575 @@ class Options(OptionParser):
         self.add_option("--save-logs-to",
                         action="store", type="string", dest="log_dest",
                         help="save client logs to this directory")
+        self.add_option("--test-timeout",
+                        action="store", type="int", dest="test_timeout",
+                        default=300,
+                        help="seconds a test may run before it is failed, unless "
+                             "its manifest entry sets a timeout")
+        self.add_option("--run-timeout",
+                        action="store", type="int", dest="run_timeout",
+                        help="seconds the whole test run may take")
+        self.add_option("--concurrency",
+                        action="store", type="int", dest="concurrency",
+                        default=1,
+                        help="number of tests to run at the same time in each session "
+                             "of clients. Tests with exclusive = true in the manifest run alone")
+        self.add_option("--preload",
+                        action="store_true", dest="preload",
+                        default=False,
+                        help="load the next test while the current ones run, so it "
+                             "starts as soon as they finish")
+        self.add_option("--stats-interval",
+                        action="store", type="int", dest="stats_interval",
+                        default=0,
+                        help="sample getStats() of every peer connection the tests create "
+                             "every STATS_INTERVAL ms and report the WebRTC statistics. "
+                             "Tests can also call collect_stats(pc) themselves")
+        self.add_option("--profile",
+                        action="store_true", dest="profile",
+                        default=False,
+                        help="log how long each phase of the run takes on the controller, "
+                             "and run the clients with the Gecko profiler. Their profiles "
+                             "are saved to the log directory")
+        self.add_option("--cprofile",
+                        action="store_true", dest="cprofile",
+                        default=False,
+                        help="profile the controller's threads with cProfile and save "
+                             "the statistics to the log directory")
+        self.add_option("--results-db",
+                        action="store", type="string", dest="results_db",
+                        help="SQLite database to record the results of every run in. "
+                             "Recently failed tests run first and durations are "
+                             "taken from it unless --test-durations is given")
+        self.add_option("--rerun-failures",
+                        action="store_true", dest="rerun_failures",
+                        default=False,
+                        help="only run the tests that failed in the last run recorded "
+                             "in the results database")
+        self.add_option("--retry-failures",
+                        action="store_true", dest="retry_failures",
+                        default=False,
+                        help="run failed tests again in new browsers after the run. "
+                             "Tests that pass then are reported as intermittent")
+        self.add_option("--timing-report",
+                        action="store", type="string", dest="timing_report",
+                        help="write the timing of all tests as JSON to this file, "
+                             "defaults to timing.json in the log directory")
+        self.add_option("--json-report",
+                        action="store", type="string", dest="json_report",
+                        help="write the outcome of every test on every client as JSON to "
+                             "this file, defaults to results.json in the log directory")
+        self.add_option("--xunit-report",
+                        action="store", type="string", dest="xunit_report",
+                        help="write the outcome of every test as xUnit XML to this file, "
+                             "defaults to results.xml in the log directory")
+        self.add_option("--from-logs",
+                        action="store", type="string", dest="from_logs",
+                        help="comma-separated client logs saved with --save-logs-to. Report "
+                             "the results in them instead of running tests")
+        self.add_option("--archive-binary",
+                        action="store_true", dest="archive_binary",
+                        default=False,
+                        help="push the directory of BINARY as a single archive instead of file by file")
+        self.add_option("--repack-package",
+                        action="store_true", dest="repack_package",
+                        default=False,
+                        help="recompress .tar.bz2 packages to a format that unpacks faster on the clients")
+        self.add_option("--cache-dir",
+                        action="store", type="string", dest="cache_dir",
+                        default=os.path.join(os.path.expanduser("~"), ".steeplechase", "cache"),
+                        help="directory to cache generated files on the controller in")
 
         self.set_usage(usage)
 
-def get_results(output):
-    """Count test passes/failures in output.
-    Return (passes, failures)."""
-    passes, failures = 0, 0
-    for line_string in output.splitlines():
-        try:
-            line_object = json.loads(line_string)
-            if not isinstance(line_object, dict):
-                continue
-            if line_object["action"] == "test_unexpected_fail":
-                failures += 1
-            elif line_object["action"] == "test_pass":
-                passes += 1
-        except ValueError:
-            pass
-    return passes, failures
+class ClientOutput(object):
+    """File-like object that receives the output of a client while it is running.
+
+       Complete lines are written to |log_file|, results are collected and passed
+       on to the |events| queue as ("result", name, record) as soon as they arrive.
+       Only the output around failures is kept in memory, up to |context_lines|
+       lines before and after each of the first |max_logs| ones. DeviceManager.shell
+       strips the return code off the last line, so seeking and reading only
+       operates on the incomplete last line, preceded by a newline."""
+
+    def __init__(self, name, events, log_file=None, context_lines=10, max_logs=50):
+        self.name = name
+        self.events = events
+        self.log_file = log_file
+        self.context_lines = context_lines
+        self.max_logs = max_logs
+        self.recent = deque(maxlen=context_lines)
+        # Logs of failures still collecting the lines after them, with
+        # the length they stop at.
+        self.open_logs = []
+        self.results = ResultSet()
+        # Set when the controller killed the browser.
+        self.killed = False
+        # Set when the controller gave up on a browser it couldn't kill.
+        self.detached = False
+        self._parser = StructuredLogParser()
+        self._pending = StringIO('\n')
+        # The controller adds failures while the client is still writing.
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        # The incomplete last line may have been changed through seek and truncate.
+        self._parser.partial = self._pending.getvalue()[1:]
+        for line, record in self._parser.parse(data):
+            self.add_line(line, record)
+        self._pending = StringIO()
+        self._pending.write('\n' + self._parser.partial)
+
+    def seek(self, *args):
+        self._pending.seek(*args)
+
+    def tell(self):
+        return self._pending.tell()
+
+    def read(self, *args):
+        return self._pending.read(*args)
+
+    def truncate(self, *args):
+        self._pending.truncate(*args)
+
+    def add_line(self, line, record):
+        """Handle a complete |line| of output and the LogRecord logged on
+        it, or None."""
+        with self._lock:
+            if self.detached:
+                return
+            if self.log_file:
+                self.log_file.write(line + '\n')
+            if self.open_logs:
+                for log, length in self.open_logs:
+                    log.append(line)
+                self.open_logs = [(log, length) for log, length in self.open_logs
+                                  if len(log) < length]
+            if isinstance(record, TestFailure) and self.max_logs:
+                record.log = list(self.recent) + [line]
+                self.open_logs.append((record.log, len(record.log) + self.context_lines))
+                self.max_logs -= 1
+            self.recent.append(line)
+            if not record:
+                return
+            self.results.add(self.name, record)
+        self.events.put(("result", self.name, record))
+
+    def add_failure(self, message, source_file="steeplechase"):
+        """Record a failure that is not reported by the harness."""
+        record = failure(message, source_file)
+        self.add_line(json.dumps(record.data), record)
+
+    def detach(self):
+        """Ignore any further output, so the results can be read while
+        the browser keeps running."""
+        with self._lock:
+            self.detached = True
+            if self.log_file:
+                self.log_file.close()
+                self.log_file = None
+
+    def close(self):
+        # DeviceManager.shell marks the end of the output with a NUL.
+        self._parser.partial = self._pending.getvalue()[1:].rstrip('\0')
+        self._pending = StringIO('\n')
+        for line, record in self._parser.finish():
+            self.add_line(line, record)
+        with self._lock:
+            if self.log_file:
+                self.log_file.close()
+                self.log_file = None
 
 class RunThread(threading.Thread):
+    """Run a browser by calling |run| with the ClientOutput it writes to,
+       which returns its exit code."""
+
     def __init__(self, args=(), **kwargs):
         threading.Thread.__init__(self, args=args, **kwargs)
         self.name = kwargs.get("name", "Thread")
         self.args = args
+        # A browser that can't be killed mustn't keep the controller alive.
+        self.daemon = True
 
     def run(self):
-        dm, cmd, env, cond, results = self.args
-        result = None
-        output = None
+        run, output, events = self.args
         try:
-            output = dm.shellCheckOutput(cmd, env=env)
-            result = get_results(output)
+            status = run(output)
+            if status != 0 and not output.killed:
+                output.add_failure("Build exited with return code %d" % status)
         except DMError as e:
-            output = "Error running build: " + e.msg
-            result = 0, 1
+            output.add_failure("Error running build: " + e.msg)
         finally:
-            #TODO: actual result
-            cond.acquire()
-            results.append((self, result, output))
-            cond.notify()
-            cond.release()
+            output.close()
+            events.put(("finished", self.name, output))
             del self.args
 
+class PhaseTimer(object):
+    """Record the wall-clock time spent in named phases."""
+
+    def __init__(self):
+        self.phases = []
+        self.current = None
+
+    def begin(self, name):
+        """Start the phase |name|, ending the current one. For phases
+        that span more than a with block."""
+        self.end()
+        self.current = (name, time.time())
+
+    def end(self):
+        if self.current:
+            name, start = self.current
+            self.phases.append((name, time.time() - start))
+            self.current = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+
+    def total(self):
+        return sum(duration for name, duration in self.phases)
+
+    def summary(self):
+        return ", ".join("%s: %.2fs" % phase for phase in self.phases)
+
+_profile_lock = threading.Lock()
+
+def unique_path(directory, name, extension):
+    """Create a new empty file |name|.|extension| in |directory| and return
+    its path. If it exists, a number is added to the name, so the files
+    of reruns and retries don't replace those of earlier runs."""
+    with _profile_lock:
+        path = os.path.join(directory, "%s.%s" % (name, extension))
+        i = 1
+        while os.path.exists(path):
+            path = os.path.join(directory, "%s-%d.%s" % (name, i, extension))
+            i += 1
+        open(path, "wb").close()
+        return path
+
+def call_profiled(options, name, func, *args):
+    """Call |func| with |args| and return its result. With --cprofile it
+    runs under cProfile and the statistics are saved to |name|.prof in the
+    log directory. cProfile only sees the calling thread, so each thread
+    worth profiling is profiled on its own."""
+    if not options.cprofile:
+        return func(*args)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(unique_path(options.log_dest, name, "prof"))
+
+class SetupThread(threading.Thread):
+    """Install the application on a single client: prepare the test root,
+       push and unpack the asset, then check the application is there."""
+
+    def __init__(self, info, log, options):
+        threading.Thread.__init__(self, name=info['name'])
+        self.info = info
+        self.log = log
+        self.options = options
+        self.timer = PhaseTimer()
+        self.error = None
+
+    def run(self):
+        info = self.info
+        try:
+            with self.timer.phase("asset"):
+                asset = create_asset(info, self.log, self.options)
+            info['test_root'] = asset.test_root()
+            info['remote_app_path'] = asset.path_to_launch()
+
+            if self.options.setup:
+                with self.timer.phase("prepare"):
+                    asset.setup_test_root()
+                self.log.info("Pushing app to %s...", info['name'])
+                with self.timer.phase("install"):
+                    asset.setup_client()
+            with self.timer.phase("check"):
+                exists = info['dm'].fileExists(info['remote_app_path'])
+                # Apps installed by hand have no manifest and can't be checked.
+                stale = (not self.options.setup and exists and
+                         asset.remote_manifest() and not asset.is_current())
+            if not exists:
+                if self.options.setup:
+                    self.error = "App was not installed to %s" % info['remote_app_path']
+                else:
+                    self.error = "App does not exist, don't use --noSetup"
+            elif stale:
+                self.error = "App is out of date, don't use --noSetup"
+        except Exception as e:
+            self.error = "Setup failed: %s" % (getattr(e, 'msg', None) or e)
+
+def setup_clients(remote_info, log, options):
+    """Install the application on all clients concurrently.
+    Return a dict mapping client names to setup errors."""
+    threads = [SetupThread(info, log, options) for info in remote_info]
+    for t in threads:
+        t.start()
+    errors = {}
+    for t in threads:
+        t.join()
+        log.info("Setup of %s took %.2fs (%s)", t.name, t.timer.total(), t.timer.summary())
+        if t.error:
+            errors[t.name] = t.error
+    return errors
+
+# Number of file hashes kept by hash_file.
+CACHED_HASHES = 50000
+
+# SHA-1 digests by absolute path, with the size and mtime they are valid for.
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+# Locks by directory, so clients sharing a build hash it only once.
+_directory_locks = {}
+
+def hash_file(path):
+    """Return the SHA-1 hex digest of the contents of |path|. The digest
+    is reused across clients and runs while the file's size and mtime stay
+    the same."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (st.st_size, st.st_mtime)
+    with _hashes_lock:
+        cached = _hashes.pop(path, None)
+        if cached is not None and cached[0] == key:
+            _hashes[path] = cached
+            return cached[1]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    with _hashes_lock:
+        _hashes[path] = (key, sha1.hexdigest())
+        while len(_hashes) > CACHED_HASHES:
+            _hashes.popitem(last=False)
+    return sha1.hexdigest()
+
+def hash_directory(path):
+    """Return a manifest of the files below |path|: a dict mapping each
+    file's path relative to |path|, using / as separator, to its SHA-1.
+    Only files that changed since they were last hashed are read."""
+    with _hashes_lock:
+        lock = _directory_locks.setdefault(os.path.abspath(path), threading.Lock())
+    manifest = {}
+    with lock:
+        for root, dirs, files in os.walk(path, followlinks=True):
+            for f in files:
+                local_file = os.path.join(root, f)
+                relpath = os.path.relpath(local_file, path).replace(os.sep, '/')
+                manifest[relpath] = hash_file(local_file)
+    return manifest
+
+def manifest_digest(manifest):
+    """Return a single SHA-1 digest for a whole manifest."""
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+_cache_lock = threading.Lock()
+
+def archive_directory(path, cache_dir, digest):
+    """Return the path of a .tar.gz archive of the contents of |path| in
+    |cache_dir|. The archive is named after |digest| and only created if
+    it is not cached yet."""
+    archive = os.path.join(cache_dir, "%s.tar.gz" % digest)
+    with _cache_lock:
+        if os.path.exists(archive):
+            return archive
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_archive = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        os.close(fd)
+        try:
+            # Follow symlinks like DeviceManager.pushDir does.
+            tar = tarfile.open(tmp_archive, "w:gz", compresslevel=6, dereference=True)
+            try:
+                for entry in sorted(os.listdir(path)):
+                    tar.add(os.path.join(path, entry), arcname=entry)
+            finally:
+                tar.close()
+            os.rename(tmp_archive, archive)
+        except:
+            mozfile.remove(tmp_archive)
+            raise
+    return archive
+
+def find_program(candidates):
+    """Return the first command line of |candidates| whose program is
+    available on the controller, or None."""
+    for cmd in candidates:
+        if find_executable(cmd[0]):
+            return cmd
+    return None
+
+def bz2_chunks(path, chunk_size=1024 * 1024):
+    """Yield the decompressed content of the .bz2 file |path| in chunks.
+    Files of several streams, like those of pbzip2, are read to the end."""
+    decompressor = bz2.BZ2Decompressor()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            while data:
+                try:
+                    yield decompressor.decompress(data)
+                except EOFError:
+                    # The last stream ended with the previous chunk.
+                    decompressor = bz2.BZ2Decompressor()
+                    continue
+                data = decompressor.unused_data
+                if data:
+                    decompressor = bz2.BZ2Decompressor()
+
+def repacked_name(path, cls):
+    """Return the file name of the copy of the .tar.bz2 file |path|
+    recompressed to the format of the Tarball subclass |cls|."""
+    base = os.path.basename(path)[:-len(TarBz2.extension)]
+    return "%s-%s%s" % (base, hash_file(path), cls.extension)
+
+def repack_tarball(path, cache_dir, cls):
+    """Return the path of a copy of the .tar.bz2 file |path| recompressed to
+    the format of the Tarball subclass |cls|. The copy is cached in
+    |cache_dir| by the content of |path|. Without a bzip2 decompressor or a
+    compressor for |cls| on the controller, Python's own modules are used."""
+    repacked = os.path.join(cache_dir, repacked_name(path, cls))
+    with _cache_lock:
+        if os.path.exists(repacked):
+            return repacked
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_repacked = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        os.close(fd)
+        try:
+            # Only the compression changes, the tar stream is passed through as is.
+            decompressor = find_program(TarBz2.decompressors + [['bzip2', '-dc']])
+            decompress = None
+            if decompressor:
+                decompress = subprocess.Popen(decompressor + [path], stdout=subprocess.PIPE)
+                chunks = iter(lambda: decompress.stdout.read(1024 * 1024), b'')
+            else:
+                chunks = bz2_chunks(path)
+            with open(tmp_repacked, 'wb') as f:
+                compressor = find_program(cls.compressors)
+                if compressor and decompress:
+                    compress = subprocess.Popen(compressor, stdin=decompress.stdout, stdout=f)
+                    decompress.stdout.close()
+                elif compressor:
+                    compress = subprocess.Popen(compressor, stdin=subprocess.PIPE, stdout=f)
+                    for chunk in chunks:
+                        compress.stdin.write(chunk)
+                    compress.stdin.close()
+                else:
+                    compress = None
+                    gz = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+                    for chunk in chunks:
+                        gz.write(chunk)
+                    gz.close()
+                if compress and compress.wait() != 0:
+                    raise Exception("%s failed" % compressor[0])
+            if decompress and decompress.wait() != 0:
+                raise Exception("Error decompressing %s" % path)
+            os.rename(tmp_repacked, repacked)
+        except:
+            mozfile.remove(tmp_repacked)
+            raise
+    return repacked
+
+def read_remote_manifest(dm, path):
+    """Return the manifest stored at |path| on the client, or an empty
+    dict if there is none or it can't be read."""
+    try:
+        if not dm.fileExists(path):
+            return {}
+        manifest = json.loads(dm.pullFile(path))
+    except (DMError, ValueError):
+        return {}
+    if not isinstance(manifest, dict):
+        return {}
+    return manifest
+
+def write_remote_manifest(dm, path, manifest):
+    """Store |manifest| at |path| on the client."""
+    with mozfile.NamedTemporaryFile() as f:
+        json.dump(manifest, f, sort_keys=True)
+        f.flush()
+        dm.pushFile(f.name, path)
+
+def tree_manifest(kind, root, files):
+    """Return the manifest of a tree of |kind| installed at |root| on the
+    client, whose |files| map paths to hashes like those of hash_directory."""
+    return {"kind": kind, "root": root, "files": files}
+
+def push_changed_files(dm, log, local_dir, remote_dir, manifest, remote_manifest):
+    """Make |remote_dir| match |local_dir|, given the manifests of both.
+    Without a remote manifest of the same kind and root the whole directory
+    is pushed, an unpacked package would be left behind otherwise. If there
+    is one, only changed files are pushed and files that no longer exist are
+    removed."""
+    if (not remote_manifest or remote_manifest.get("kind") != manifest["kind"] or
+        remote_manifest.get("root") != manifest["root"]):
+        log.debug("Pushing %s to %s..." % (local_dir, remote_dir))
+        dm.removeDir(remote_dir)
+        dm.mkDir(remote_dir)
+        dm.pushDir(local_dir, remote_dir)
+        return
+
+    files, remote_files = manifest["files"], remote_manifest.get("files") or {}
+    changed = sorted(f for f in files if remote_files.get(f) != files[f])
+    removed = sorted(f for f in remote_files if f not in files)
+    log.debug("Pushing %d changed files from %s to %s, removing %d..." %
+              (len(changed), local_dir, remote_dir, len(removed)))
+    for f in removed:
+        dm.removeFile(posixpath.join(remote_dir, f))
+    for f in changed:
+        dm.pushFile(os.path.join(local_dir, *f.split('/')), posixpath.join(remote_dir, f))
+
+def copy_remote_files(dm, source_dir, dest_dir, files):
+    """Copy the |files| of a manifest from |source_dir| to |dest_dir| on the
+    client. Only DeviceManager commands are used, no shell, so it works on
+    clients of any platform."""
+    dirs = set([""])
+    for f in files:
+        parts = f.split('/')[:-1]
+        for i in range(1, len(parts) + 1):
+            dirs.add('/'.join(parts[:i]))
+    for d in sorted(dirs):
+        dm.mkDir(posixpath.join(dest_dir, d) if d else dest_dir)
+    for f in sorted(files):
+        dm.copyTree(posixpath.join(source_dir, f), posixpath.join(dest_dir, f))
+
+def prune_cache(directory, keep):
+    """Remove all but the |keep| most recently used entries of |directory|."""
+    entries = [os.path.join(directory, entry) for entry in os.listdir(directory)]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for path in entries[keep:]:
+        mozfile.remove(path)
+
+def sync_directory(dm, log, local_dir, remote_dir, files):
+    """Make |remote_dir| on the client a copy of |local_dir|, whose files
+    are hashed in |files|. The manifest of the remote copy is kept in
+    |remote_dir|.manifest, nothing is pushed if it is current."""
+    manifest = tree_manifest("directory", remote_dir, files)
+    manifest_path = remote_dir + ".manifest"
+    remote_manifest = {}
+    if dm.dirExists(remote_dir):
+        remote_manifest = read_remote_manifest(dm, manifest_path)
+    if remote_manifest == manifest:
+        return
+    dm.removeFile(manifest_path)
+    push_changed_files(dm, log, local_dir, remote_dir, manifest, remote_manifest)
+    write_remote_manifest(dm, manifest_path, manifest)
+
 class ApplicationAsset(object):
-    """A class for handling the binaries or packages to be installed and run by steeplechase"""
+    """A class for handling the binaries or packages to be installed and run by steeplechase.
+
+       A manifest of content hashes is kept next to the application on the client, so an
+       application that is already installed is only pushed again when its content changed."""
+
+    # Entries of the test root that are kept between runs.
+    cached_entries = ("app", "app.manifest", "profile-base", "profile-base.manifest")
 
     def __init__(self, path, log, dm, name):
         self._path = path
@@ -127,6 +706,8 @@ class ApplicationAsset(object):
         self._name = name
         self._test_root = posixpath.join(dm.getDeviceRoot(), "steeplechase-" + name)
         self._remote_path = posixpath.join(self._test_root, "app")
+        self._manifest_path = posixpath.join(self._test_root, "app.manifest")
+        self._manifest = None
 
     def remote_path(self):
         return self._remote_path
@@ -135,13 +716,57 @@ class ApplicationAsset(object):
         return self._test_root
 
     def setup_test_root(self):
-        if self._dm.dirExists(self._test_root):
-            self._dm.removeDir(self._test_root)
-        self._dm.mkDir(self._test_root)
+        """Create an empty test root on the client, keeping the installed application."""
+        if not self._dm.dirExists(self._test_root):
+            self._dm.mkDir(self._test_root)
+            return
+        for entry in self._dm.listFiles(self._test_root):
+            if entry in self.cached_entries:
+                continue
+            path = posixpath.join(self._test_root, entry)
+            if self._dm.dirExists(path):
+                self._dm.removeDir(path)
+            else:
+                self._dm.removeFile(path)
+
+    def local_manifest(self):
+        """Return the manifest of the content to install. It includes the kind
+        of asset, a package can't be updated file by file into a binary."""
+        if self._manifest is None:
+            self._manifest = tree_manifest(type(self).__name__, self._remote_path,
+                                           self.compute_manifest())
+        return self._manifest
+
+    def compute_manifest(self):
+        """Hash the content to install. Returns a dict mapping names to hashes."""
+        raise NotImplementedError('Implement compute_manifest()')
+
+    def remote_manifest(self):
+        """Return the manifest of the application installed on the client."""
+        if not self._dm.dirExists(self._remote_path):
+            return {}
+        return read_remote_manifest(self._dm, self._manifest_path)
+
+    def is_current(self):
+        """Return True if the client already has this application installed."""
+        return self.remote_manifest() == self.local_manifest()
 
     def setup_client(self):
-        """Copy and do any unarchiving of the binaries or packages on the client"""
-        raise NotImplementedError('Implement setup_client()')
+        """Install the application on the client unless it is already current."""
+        manifest = self.local_manifest()
+        remote_manifest = self.remote_manifest()
+        if remote_manifest == manifest:
+            self._log.info("%s already has %s, not pushing it" % (self._name, self._path))
+            return
+        # Drop the manifest first so an interrupted install is never considered current.
+        self._dm.removeFile(self._manifest_path)
+        self.install(remote_manifest)
+        write_remote_manifest(self._dm, self._manifest_path, manifest)
+
+    def install(self, remote_manifest):
+        """Copy and do any unarchiving of the binaries or packages on the client.
+        |remote_manifest| describes what is currently installed there."""
+        raise NotImplementedError('Implement install()')
 
     def path_to_launch(self):
         """Return the path to the firefox executable on the remote machine"""
@@ -151,15 +776,37 @@ class Binary(ApplicationAsset):
     """Copy a directory containing firefox to the client. Note that this does not work in versions of Mac
        Firefox with the v2 application layout."""
 
-    def setup_client(self):
-        self._log.debug("Pushing %s to %s..." % (self._path, self._remote_path))
-        self._dm.mkDir(self._remote_path)
-        self._dm.pushDir(posixpath.dirname(self._path), self._remote_path)
+    def compute_manifest(self):
+        return hash_directory(os.path.dirname(self._path))
+
+    def install(self, remote_manifest):
+        push_changed_files(self._dm, self._log, os.path.dirname(self._path), self._remote_path,
+                           self.local_manifest(), remote_manifest)
 
     def path_to_launch(self):
         app = os.path.basename(self._path)
         return posixpath.join(self._remote_path, app)
 
+class LocalBinary(ApplicationAsset):
+    """Run firefox from its directory on the controller, for clients on a
+       LocalDevice. Nothing is copied."""
+
+    def __init__(self, path, log, dm, name):
+        ApplicationAsset.__init__(self, path, log, dm, name)
+        self._remote_path = os.path.dirname(os.path.abspath(path))
+
+    def compute_manifest(self):
+        return {}
+
+    def remote_manifest(self):
+        return {}
+
+    def setup_client(self):
+        self._log.info("%s runs %s in place" % (self._name, self._path))
+
+    def path_to_launch(self):
+        return os.path.abspath(self._path)
+
 class Package(ApplicationAsset):
     """Copy an archive to the client and unarchive it."""
 
@@ -167,17 +814,27 @@ class Package(ApplicationAsset):
         """Name of the archive file."""
         return os.path.basename(self._path)
 
+    def local_archive(self):
+        """Path of the archive file on the controller."""
+        return self._path
+
     def remote_archive_name(self):
         """Name of the archive file on the client."""
         return posixpath.join(self._remote_path, self.archive_name())
 
     def push(self):
         """Copy the archive file to the remote machine."""
-        self._log.debug("Pushing %s to %s..." % (self._path, self._remote_path))
+        local_archive = self.local_archive()
+        self._log.debug("Pushing %s to %s..." % (local_archive, self._remote_path))
         self._dm.mkDir(self._remote_path)
-        self._dm.pushFile(self._path, self.remote_archive_name())
+        self._dm.pushFile(local_archive, self.remote_archive_name())
 
-    def setup_client(self):
+    def compute_manifest(self):
+        return {self.archive_name(): hash_file(self._path)}
+
+    def install(self, remote_manifest):
+        # Unpacking over an older version could leave stale files behind.
+        self._dm.removeDir(self._remote_path)
         self.push()
         self.unpack()
 
@@ -185,17 +842,90 @@ class Package(ApplicationAsset):
         """Unarchive the archive file to a binary directory on the client machine."""
         raise NotImplementedError('Implement unpack()')
 
-class TarBz2(Package):
-    """Intended for Linux packages. Client commands assume Linux."""
+class Tarball(Package):
+    """Intended for Linux packages. Client commands assume Linux. Archives are
+       decompressed with a parallel decompressor if the client has one."""
+
+    extension = None
+    # Command lines that decompress the archive to stdout, in order of preference.
+    decompressors = []
+    # Arguments for tar to extract the archive without any of the decompressors.
+    tar_args = []
+    # Command lines that compress stdin to stdout on the controller.
+    compressors = []
+
+    def __init__(self, path, log, dm, name, repack_dir=None):
+        Package.__init__(self, path, log, dm, name)
+        # With |repack_dir|, |path| is a .tar.bz2 package that is only
+        # recompressed to this format, into |repack_dir|, when it is pushed.
+        self._repack_dir = repack_dir
+
+    def archive_name(self):
+        if self._repack_dir:
+            return repacked_name(self._path, type(self))
+        return Package.archive_name(self)
+
+    def local_archive(self):
+        if self._repack_dir:
+            self._log.info("Repacking %s as %s for %s..." % (self._path, self.extension, self._name))
+            return repack_tarball(self._path, self._repack_dir, type(self))
+        return self._path
+
+    def client_has(self, program):
+        """Return True if |program| is on the PATH of the client."""
+        try:
+            self._dm.shellCheckOutput(['which', program], env=None)
+            return True
+        except DMError:
+            return False
 
     def unpack(self):
-        cmd = ['cd', self._remote_path, ';', 'tar', 'xjf', self.remote_archive_name()]
+        archive = self.remote_archive_name()
+        cmd = ['cd', self._remote_path, ';', 'tar'] + self.tar_args + [archive]
+        for decompressor in self.decompressors:
+            if self.client_has(decompressor[0]):
+                cmd = ['cd', self._remote_path, ';'] + decompressor + [archive, '|', 'tar', 'xf', '-']
+                break
         self._log.debug("Running %s on remote host.." % cmd)
         output = self._dm.shellCheckOutput(cmd, env=None)
 
     def path_to_launch(self):
         return posixpath.join(self._remote_path, 'firefox', 'firefox')
 
+class TarBz2(Tarball):
+    extension = '.tar.bz2'
+    decompressors = [['lbzip2', '-dc'], ['pbzip2', '-dc']]
+    tar_args = ['xjf']
+
+    def repacked(self, cache_dir):
+        """Return an asset for this package recompressed on the controller to
+        the fastest format the client can unpack. zstd is used if both the
+        controller and the client have it, gzip otherwise. The package is
+        only recompressed when the asset is pushed."""
+        cls = TarGz
+        if find_program(TarZst.compressors) and self.client_has('zstd'):
+            cls = TarZst
+        return cls(self._path, self._log, self._dm, self._name, repack_dir=cache_dir)
+
+class TarGz(Tarball):
+    extension = '.tar.gz'
+    decompressors = [['pigz', '-dc']]
+    tar_args = ['xzf']
+    compressors = [['pigz', '-6', '-c'], ['gzip', '-6', '-c']]
+
+class TarXz(Tarball):
+    extension = '.tar.xz'
+    # xz only decompresses in parallel from version 5.4 on, older ones ignore -T.
+    decompressors = [['xz', '-T0', '-dc']]
+    tar_args = ['xJf']
+
+class TarZst(Tarball):
+    extension = '.tar.zst'
+    decompressors = [['zstd', '-T0', '-dc']]
+    # Requires GNU tar 1.31 or later.
+    tar_args = ['--zstd', '-xf']
+    compressors = [['zstd', '-q', '-T0', '-3', '-c']]
+
 class Zip(Package):
     """Intended for Windows packages. Client commands assume Windows."""
 
@@ -240,6 +970,30 @@ class Dmg(Package):
     def path_to_launch(self):
         return posixpath.join(self._remote_path, 'firefox.app', 'Contents', 'MacOS', 'firefox')
 
+class PackedBinary(TarGz):
+    """Copy a directory containing firefox to the client as a single archive, which is
+       created on the controller and cached by the content of the directory. Client
+       commands assume Linux or Mac."""
+
+    def __init__(self, path, log, dm, name, cache_dir):
+        TarGz.__init__(self, path, log, dm, name)
+        self._cache_dir = cache_dir
+
+    def compute_manifest(self):
+        # The archive itself isn't reproducible, so use the directory content.
+        return {'directory': manifest_digest(hash_directory(os.path.dirname(self._path)))}
+
+    def archive_name(self):
+        return "%s.tar.gz" % self.local_manifest()['files']['directory']
+
+    def local_archive(self):
+        return archive_directory(os.path.dirname(self._path), self._cache_dir,
+                                 self.local_manifest()['files']['directory'])
+
+    def path_to_launch(self):
+        app = os.path.basename(self._path)
+        return posixpath.join(self._remote_path, app)
+
 def generate_package_asset(path, log, dm, name):
     """Factory method to return an asset object to push and unpack the object to the client."""
 
@@ -251,16 +1005,217 @@ def generate_package_asset(path, log, dm, name):
         asset = Dmg(path, log, dm, name)
     elif path.endswith('.tar.bz2'):
         asset = TarBz2(path, log, dm, name)
+    elif path.endswith('.tar.gz') or path.endswith('.tgz'):
+        asset = TarGz(path, log, dm, name)
+    elif path.endswith('.tar.xz'):
+        asset = TarXz(path, log, dm, name)
+    elif path.endswith('.tar.zst'):
+        asset = TarZst(path, log, dm, name)
     else:
         raise "generate_packages_asset(%s) called with unknown extension." % path
     return asset
 
+def create_asset(info, log, options):
+    """Return the asset object for the application of a client."""
+    if info['binary'] and isinstance(info['dm'], LocalDevice):
+        return LocalBinary(path=info['binary'], log=log, dm=info['dm'], name=info['name'])
+    if not info['binary']:
+        asset = generate_package_asset(path=info['package'], log=log, dm=info['dm'], name=info['name'])
+        if options.repack_package and isinstance(asset, TarBz2):
+            asset = asset.repacked(options.cache_dir)
+        return asset
+    if options.archive_binary:
+        return PackedBinary(path=info['binary'], log=log, dm=info['dm'], name=info['name'],
+                            cache_dir=options.cache_dir)
+    return Binary(path=info['binary'], log=log, dm=info['dm'], name=info['name'])
+
+def shard_tests(tests, count, durations=None):
+    """Split |tests| into |count| shards that take about the same time,
+    going by the test durations in seconds in |durations|. Tests without a
+    known duration are assumed to take the average time. Tests keep their
+    manifest order within a shard."""
+    durations = durations or {}
+    known = [durations[t['path']] for t in tests if t['path'] in durations]
+    default = sum(known) / len(known) if known else 1.0
+    loads = [0.0] * count
+    shard_of = {}
+    # Place the longest tests first, on the least loaded shard.
+    for i in sorted(range(len(tests)), key=lambda i: -durations.get(tests[i]['path'], default)):
+        shard = loads.index(min(loads))
+        loads[shard] += durations.get(tests[i]['path'], default)
+        shard_of[i] = shard
+    shards = [[] for _ in range(count)]
+    for i, test in enumerate(tests):
+        shards[shard_of[i]].append(test)
+    return shards
+
+def read_hosts(options):
+    """Return the list of remote hosts given in the options."""
+    if options.hosts_file:
+        with open(options.hosts_file) as f:
+            lines = [line.split('#')[0].strip() for line in f]
+        return [line for line in lines if line]
+    if options.hosts:
+        return [host.strip() for host in options.hosts.split(',') if host.strip()]
+    if options.local and not (options.host1 and options.host2):
+        return [LOCAL_HOST] * options.session_size
+    return [options.host1, options.host2]
+
+def client_role(options, index):
+    """Return the role of the client with |index| in its session."""
+    if options.roles:
+        return options.roles.split(',')[index].strip()
+    return "initiator" if index == 0 else "responder"
+
+def create_device(host):
+    """Return a DeviceManager for |host|, which may include a port, or a
+    LocalDevice for clients on this machine."""
+    if host == LOCAL_HOST:
+        return LocalDevice()
+    if ':' in host:
+        host, port = host.split(':')
+        return DeviceManagerSUT(host, port)
+    return DeviceManagerSUT(host)
+
+def run_shards(httpd, sessions, shards, log, options, append_logs=False, prefix="/",
+               on_record=None, relay=None):
+    """Run HTMLTests on each session of clients in |sessions| concurrently,
+    session i running the tests |shards|[i], whose manifest is served at
+    |prefix|manifest/i.json and which are served under |prefix|tests/.
+    Return the ResultSet of all sessions. Clients post their statistics to
+    |prefix|stats. With
+    |append_logs| the client logs of an earlier run are kept. |on_record| is
+    called with the client name and each record as they arrive. |relay| is
+    the SignallingRelay of the web server, if it has one."""
+    results = [ResultSet() for session in sessions]
+
+    def run_session(i):
+        try:
+            test = HTMLTests(httpd, sessions[i], shards[i], log, options,
+                             manifest_url="%smanifest/%d.json" % (prefix, i),
+                             append_logs=append_logs,
+                             tests_url=prefix + "tests/",
+                             stats_url=prefix + "stats",
+                             on_record=on_record,
+                             relay=relay)
+            results[i] = call_profiled(options, "session%d" % i, test.run)
+        except Exception as e:
+            log.error("Error running tests on %s: %s",
+                      ", ".join(info['name'] for info in sessions[i]), e)
+            results[i].add(sessions[i][0]['name'], failure("Error running tests: %s" % e))
+        for test in shards[i]:
+            results[i].expect(test["path"], [info['name'] for info in sessions[i]])
+
+    threads = [threading.Thread(target=run_session, args=(i,)) for i in range(len(sessions))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    all_results = ResultSet()
+    for session_results in results:
+        all_results.update(session_results)
+    return all_results
+
+# Number of base profiles kept in the cache directory.
+CACHED_PROFILES = 5
+
+# Seconds to wait beyond a test's timeout before a browser is considered hung.
+HANG_GRACE_PERIOD = 60
+# Seconds to wait for killed browsers to exit before killing them again,
+# and how often to try before giving up on them.
+KILL_GRACE_PERIOD = 15
+KILL_ATTEMPTS = 2
+
 class HTMLTests(object):
-    def __init__(self, httpd, remote_info, log, options):
+    def __init__(self, httpd, remote_info, tests, log, options, manifest_url="/manifest.json",
+                 append_logs=False, tests_url="/tests/", stats_url="/stats", on_record=None,
+                 relay=None):
         self.remote_info = remote_info
+        # The manifest entries of the tests served at |manifest_url|.
+        self.tests = tests
         self.log = log
         self.options = options
         self.httpd = httpd
+        self.manifest_url = manifest_url
+        self.append_logs = append_logs
+        self.tests_url = tests_url
+        self.stats_url = stats_url
+        self.on_record = on_record
+        self.relay = relay
+
+    def base_profile(self, prefs):
+        """Return the path of a profile with |prefs| and the specialpowers
+        extension. It is built once and cached on the controller for each
+        combination of these, only the CACHED_PROFILES most recently used
+        ones are kept. Nothing in it may depend on the web server, whose
+        port changes between runs."""
+        key = manifest_digest({'prefs': prefs,
+                               'specialpowers': hash_directory(self.options.specialpowers)})
+        profiles_dir = os.path.join(self.options.cache_dir, "profiles")
+        profile_path = os.path.join(profiles_dir, key)
+        with _cache_lock:
+            if os.path.isdir(profile_path):
+                os.utime(profile_path, None)
+                return profile_path
+            if not os.path.isdir(profiles_dir):
+                os.makedirs(profiles_dir)
+            print "Writing base profile %s..." % key
+            tmp_path = tempfile.mkdtemp(dir=profiles_dir)
+            try:
+                FirefoxProfile(profile=tmp_path,
+                               preferences=prefs,
+                               addons=[self.options.specialpowers],
+                               restore=False)
+                os.rename(tmp_path, profile_path)
+            except:
+                mozfile.remove(tmp_path)
+                raise
+            prune_cache(profiles_dir, CACHED_PROFILES)
+        return profile_path
+
+    def permissions_db(self, locations):
+        """Write the permissions of |locations| to a permissions.sqlite in
+        a new directory and return its path. It is pushed along with the
+        preferences of each run."""
+        overlay_dir = tempfile.mkdtemp(prefix="steeplechase-overlay-")
+        Permissions(overlay_dir, locations)
+        return os.path.join(overlay_dir, "permissions.sqlite")
+
+    def push_profile(self, info, base_profile, base_manifest, run_prefs, permissions, timer):
+        """Set up a profile on a client from the cached |base_profile| and
+        the preferences and the |permissions| database of this run,
+        |run_prefs|. Return its remote path."""
+        dm = info['dm']
+        remote_base_profile = posixpath.join(info['test_root'], "profile-base")
+        remote_profile_path = posixpath.join(info['test_root'], "profile")
+        if isinstance(dm, LocalDevice):
+            # Copy the cached base profile directly, there is nothing to push.
+            with timer.phase("copy"):
+                dm.removeDir(remote_profile_path)
+                shutil.copytree(base_profile, remote_profile_path)
+            with timer.phase("overlay"):
+                with open(os.path.join(remote_profile_path, "prefs.js"), "a") as f:
+                    Preferences.write(f, run_prefs)
+                shutil.copy(permissions, remote_profile_path)
+            return remote_profile_path
+        with timer.phase("base"):
+            print "Pushing base profile to %s..." % info['name']
+            sync_directory(dm, self.log, base_profile, remote_base_profile, base_manifest)
+        with timer.phase("copy"):
+            dm.removeDir(remote_profile_path)
+            copy_remote_files(dm, remote_base_profile, remote_profile_path, base_manifest)
+        with timer.phase("overlay"):
+            dm.pushFile(permissions, posixpath.join(remote_profile_path, "permissions.sqlite"))
+            # Firefox reads prefs.js before user.js, which holds the base preferences.
+            with mozfile.NamedTemporaryFile() as f:
+                base_prefs_js = os.path.join(base_profile, "prefs.js")
+                if os.path.isfile(base_prefs_js):
+                    with open(base_prefs_js) as base_prefs:
+                        f.write(base_prefs.read())
+                Preferences.write(f, run_prefs)
+                f.flush()
+                dm.pushFile(f.name, posixpath.join(remote_profile_path, "prefs.js"))
+        return remote_profile_path
 
     def run(self):
         if self.options.remote_webserver:
@@ -276,84 +1231,399 @@ class HTMLTests(object):
 
         #TODO: use Preferences.read when prefs_general.js has been updated
         prefpath = self.options.prefs
-        prefs = {}
-        prefs.update(Preferences.read_prefs(prefpath))
         interpolation = { "server": "%s:%d" % (httpd_host, httpd_port),
                           "OOP": "false"}
-        prefs = json.loads(json.dumps(prefs) % interpolation)
-        for pref in prefs:
-          prefs[pref] = Preferences.cast(prefs[pref])
-        prefs["steeplechase.signalling_server"] = self.options.signalling_server
-        prefs["steeplechase.signalling_room"] = str(uuid.uuid4())
+        prefs = {}
+        # Prefs naming the web server change with its port, they are part of
+        # the overlay of each run, so the cached base profile doesn't.
+        self.server_prefs = {}
+        for name, value in Preferences.read_prefs(prefpath):
+            raw = json.dumps(value)
+            target = self.server_prefs if "%(server)" in raw else prefs
+            target[name] = Preferences.cast(json.loads(raw % interpolation))
         prefs["media.navigator.permission.disabled"] = True
         prefs["media.navigator.streams.fake"] = True
 
-        specialpowers_path = self.options.specialpowers
+        timer = PhaseTimer()
+        timer.begin("profile")
+        base_profile = self.base_profile(prefs)
+
+        self.base_profile_path = base_profile
+        self.base_manifest = hash_directory(base_profile)
+        self.permissions = self.permissions_db(locations)
+        self.url = 'http://%s:%d/index.html' % (httpd_host, httpd_port)
+
+        deadline = None
+        if self.options.run_timeout:
+            deadline = time.time() + self.options.run_timeout
+        events = Queue()
+        results = ResultSet()
+        session = 0
+        start_test = 0
+        # Indices of the tests a browser hung in, they are not run again.
+        self.skip_tests = set()
+        # A hung browser is killed and the clients start again at the first
+        # test that didn't finish.
+        try:
+            while start_test is not None:
+                timer.begin("launch")
+                threads = self.launch(start_test, session, events)
+                timer.begin("tests")
+                start_test = self.wait_for_clients(threads, events, deadline)
+                timer.begin("teardown")
+                if self.relay:
+                    # Killed browsers never leave their room.
+                    self.relay.remove(self.room)
+                for t in threads:
+                    output = t.output
+                    if not output.detached:
+                        t.join()
+                    results.update(output.results)
+                    if output.results.failures:
+                        self.log.error("Error in %s" % t.name)
+                if self.options.profile:
+                    for info in self.remote_info:
+                        self.pull_gecko_profile(info)
+                session += 1
+        finally:
+            mozfile.remove(os.path.dirname(self.permissions))
+        timer.end()
+        self.fail_tests_not_run(results)
+        self.log.info("All clients finished")
+        if self.options.profile:
+            self.log.info("Run on %s took %.2fs (%s)",
+                          ", ".join(info['name'] for info in self.remote_info),
+                          timer.total(), timer.summary())
+        return results
+
+    def fail_tests_not_run(self, results):
+        """Add a failure to |results| for every test that never started on
+        a client, because the run timed out or a browser hung before it."""
+        for test in self.tests:
+            for info in self.remote_info:
+                key = (test["path"], info['name'])
+                if key in results.tests and results.tests[key].start_time is not None:
+                    continue
+                record = failure("Test was not run", test["path"])
+                self.log.error("%s: TEST-UNEXPECTED-FAIL | %s | %s", info['name'],
+                               test["path"], record.message)
+                results.add(info['name'], record)
+                if self.on_record:
+                    self.on_record(info['name'], record)
+
+    def gecko_profile_path(self, info):
+        return posixpath.join(info['test_root'], "gecko-profile.json")
+
+    def pull_gecko_profile(self, info):
+        """Copy the profile the Gecko profiler wrote when the browser on
+        the client |info| exited to the log directory."""
+        dm = info['dm']
+        remote_path = self.gecko_profile_path(info)
+        try:
+            if not dm.fileExists(remote_path):
+                # The browser was killed or doesn't support the profiler.
+                self.log.warning("%s wrote no Gecko profile", info['name'])
+                return
+            local_path = unique_path(self.options.log_dest,
+                                     "%s-gecko-profile" % info['name'], "json")
+            dm.getFile(remote_path, local_path)
+            dm.removeFile(remote_path)
+            self.log.info("Saved Gecko profile of %s to %s", info['name'], local_path)
+        except DMError as e:
+            self.log.error("Error getting Gecko profile from %s: %s", info['name'], e.msg)
+
+    def launch(self, start_test, session, events):
+        """Push fresh profiles and start the browsers on all clients, running
+        the tests from index |start_test| on. Return the RunThreads."""
+        # Only these differ between clients and runs, they are pushed as a prefs.js overlay.
+        run_prefs = dict(self.server_prefs)
+        if self.options.builtin_signalling:
+            run_prefs["steeplechase.signalling_relay"] = "/relay/"
+        else:
+            run_prefs["steeplechase.signalling_server"] = self.options.signalling_server
+        # Identifies this launch of the browsers, its signalling room and statistics.
+        self.room = str(uuid.uuid4())
+        run_prefs["steeplechase.signalling_room"] = self.room
+        run_prefs["steeplechase.launch"] = self.room
+        run_prefs["steeplechase.manifest_url"] = self.manifest_url
+        run_prefs["steeplechase.tests_url"] = self.tests_url
+        run_prefs["steeplechase.test_timeout"] = self.options.test_timeout
+        run_prefs["steeplechase.start_test"] = start_test
+        run_prefs["steeplechase.skip_tests"] = ",".join(str(i) for i in sorted(self.skip_tests))
+        run_prefs["steeplechase.concurrency"] = self.options.concurrency
+        run_prefs["steeplechase.preload"] = self.options.preload
+        run_prefs["steeplechase.stats_interval"] = self.options.stats_interval
+        run_prefs["steeplechase.stats_url"] = self.stats_url
+        run_prefs["steeplechase.num_clients"] = len(self.remote_info)
+
         threads = []
-        results = []
-        cond = threading.Condition()
         for info in self.remote_info:
-            with mozfile.TemporaryDirectory() as profile_path:
-                # Create and push profile
-                print "Writing profile for %s..." % info['name']
-                prefs["steeplechase.is_initiator"] = info['is_initiator']
-                profile = FirefoxProfile(profile=profile_path,
-                                         preferences=prefs,
-                                         addons=[specialpowers_path],
-                                         locations=locations)
-                print "Pushing profile to %s..." % info['name']
-                remote_profile_path = posixpath.join(info['test_root'], "profile")
-                info['dm'].mkDir(remote_profile_path)
-                info['dm'].pushDir(profile_path, remote_profile_path)
-                info['remote_profile_path'] = remote_profile_path
+            timer = PhaseTimer()
+            run_prefs["steeplechase.is_initiator"] = info['is_initiator']
+            run_prefs["steeplechase.client_index"] = info['index']
+            run_prefs["steeplechase.role"] = info['role']
+            run_prefs["steeplechase.client_name"] = info['name']
+            info['remote_profile_path'] = self.push_profile(info, self.base_profile_path,
+                                                            self.base_manifest, run_prefs,
+                                                            self.permissions, timer)
+            self.log.info("Profile setup for %s took %.2fs (%s)",
+                          info['name'], timer.total(), timer.summary())
 
             env = {}
             env["MOZ_CRASHREPORTER_NO_REPORT"] = "1"
             env["XPCOM_DEBUG_BREAK"] = "warn"
-            env["DISPLAY"] = self.options.remote_xdisplay
 
-            cmd = [info['remote_app_path'], "-no-remote",
-                   "-profile", info['remote_profile_path'],
-                   'http://%s:%d/index.html' % (httpd_host, httpd_port)]
-            print "cmd: %s" % (cmd, )
+            dm = info['dm']
+            if self.options.profile:
+                # The profile is written when the browser exits.
+                dm.removeFile(self.gecko_profile_path(info))
+                env["MOZ_PROFILER_STARTUP"] = "1"
+                env["MOZ_PROFILER_SHUTDOWN"] = self.gecko_profile_path(info)
+            if isinstance(dm, LocalDevice):
+                run = partial(dm.runApplication, info['remote_app_path'],
+                              info['remote_profile_path'], ["-no-remote", self.url], env)
+            else:
+                env["DISPLAY"] = self.options.remote_xdisplay
+                cmd = [info['remote_app_path'], "-no-remote",
+                       "-profile", info['remote_profile_path'],
+                       self.url]
+                print "cmd: %s" % (cmd, )
+                run = partial(dm.shell, cmd, env=env)
+            run = partial(call_profiled, self.options, "%s-output" % info['name'], run)
+            log_file = None
+            if self.options.log_dest:
+                log_file = open(os.path.join(self.options.log_dest,
+                                             "%s.log" % info['name']),
+                                "ab" if session or self.append_logs else "wb")
+            output = ClientOutput(info['name'], events, log_file)
             t = RunThread(name=info['name'],
-                          args=(info['dm'], cmd, env, cond, results))
+                          args=(run, output, events))
+            t.output = output
             threads.append(t)
 
         for t in threads:
             t.start()
-
+        return threads
+
+    def wait_for_clients(self, threads, events, deadline):
+        """Log results as they arrive until all |threads| have finished.
+        If a browser stops making progress for longer than the timeouts of
+        its tests allow, fail the tests it hung in, kill the browsers and
+        return the index of the test to resume at. Otherwise return None.
+        Browsers that are still running after being killed KILL_ATTEMPTS
+        times are given up on, and the session ends."""
         self.log.info("Waiting for results...")
-        pass_count, fail_count = 0, 0
-        outputs = {}
-        while threads:
-            cond.acquire()
-            while not results:
-                cond.wait()
-            thread, result, output = results.pop(0)
-            cond.release()
-            outputs[thread.name] = output
-            passes, failures = result
-            #XXX: double-counting tests from both clients. Ok?
-            pass_count += passes
-            fail_count += failures
-            if failures:
-                self.log.error("Error in %s" % thread.name)
-            threads.remove(thread)
-        self.log.info("All clients finished")
+        outputs = dict((t.name, t.output) for t in threads)
+        running = set(outputs)
+        last_activity = dict((name, time.time()) for name in running)
+        # The TestStarts of the tests that started but didn't end, by index.
+        open_tests = dict((name, {}) for name in running)
+        started = set()
+        resume_at = None
+        killed_at = None
+        kills = 0
+        while running:
+            try:
+                kind, name, record = events.get(timeout=1)
+            except Empty:
+                pass
+            else:
+                last_activity[name] = time.time()
+                if kind != "finished" and self.on_record:
+                    self.on_record(name, record)
+                if kind == "finished":
+                    running.discard(name)
+                elif isinstance(record, TestStart):
+                    if record.index is not None:
+                        open_tests[name][record.index] = record
+                        started.add(record.index)
+                    self.log.info("%s: TEST-START | %s", name, record.source_file)
+                elif isinstance(record, TestFailure):
+                    self.log.error("%s: TEST-UNEXPECTED-FAIL | %s | %s", name,
+                                   record.source_file, record.message)
+                elif isinstance(record, TestPass):
+                    self.log.debug("%s: TEST-PASS | %s | %s", name,
+                                   record.source_file, record.message)
+                elif isinstance(record, TestEnd):
+                    open_tests[name].pop(record.index, None)
+                    self.log.debug("%s: TEST-END | %s | %s", name,
+                                   record.source_file, record.status)
+            now = time.time()
+            if killed_at is not None:
+                if now - killed_at <= KILL_GRACE_PERIOD:
+                    continue
+                still_running = dict((name, outputs[name]) for name in running)
+                if kills < KILL_ATTEMPTS:
+                    self.log.error("%s still running %ds after killing them, killing them again",
+                                   ", ".join(sorted(running)), now - killed_at)
+                    self.kill_clients(still_running, force=True)
+                    killed_at, kills = now, kills + 1
+                    continue
+                for name, output in still_running.iteritems():
+                    message = "Browser could not be killed, gave up on it"
+                    self.log.error("%s: %s", name, message)
+                    output.add_failure(message)
+                    output.detach()
+                return None
+
+            if deadline and now > deadline:
+                self.log.error("Run timed out after %ds" % self.options.run_timeout)
+                for name in running:
+                    outputs[name].add_failure("Run timed out after %ds" % self.options.run_timeout)
+                self.kill_clients(outputs)
+                killed_at, kills = now, 1
+                continue
+            for name in running:
+                tests = open_tests[name].values()
+                # The harness fails timed out tests itself, so allow some slack.
+                limit = max([t.timeout for t in tests if t.timeout] +
+                            [self.options.test_timeout]) + HANG_GRACE_PERIOD
+                if now - last_activity[name] <= limit:
+                    continue
+                idle = now - last_activity[name]
+                hung = [(name, t) for t in tests]
+                if not hung:
+                    # Hung between tests, blame those running on the others.
+                    hung = [(other, t) for other in open_tests
+                            for t in open_tests[other].itervalues()]
+                if not hung and not started:
+                    message = "Browser hung in startup, killed it after %ds" % idle
+                    self.log.error("%s: %s", name, message)
+                    outputs[name].add_failure(message)
+                for client, test in hung:
+                    message = "Browser hung in %s, killed it after %ds" % (test.source_file, idle)
+                    self.log.error("%s: %s", client, message)
+                    outputs[client].add_failure(message, test.source_file)
+                    self.skip_tests.add(test.index)
+                unfinished = set(index for other in open_tests.itervalues() for index in other)
+                unfinished -= self.skip_tests
+                if unfinished:
+                    resume_at = min(unfinished)
+                elif started:
+                    resume_at = max(started) + 1
+                # Without any test started, the next browser would hang the same way.
+                if resume_at is not None and resume_at >= len(self.tests):
+                    resume_at = None
+                self.kill_clients(outputs)
+                killed_at, kills = now, 1
+                break
+        return resume_at
+
+    def kill_clients(self, outputs, force=False):
+        """Kill the browsers of the clients whose ClientOutputs are in
+        |outputs|, with SIGKILL if |force| is set. Their exit codes are
+        expected then, so the ClientOutputs stop reporting them."""
+        for output in outputs.itervalues():
+            output.killed = True
         for info in self.remote_info:
-            if self.options.log_dest:
-                with open(os.path.join(self.options.log_dest,
-                                       "%s.log" % info['name']), "wb") as f:
-                    f.write(outputs[info['name']])
-            if fail_count:
-                self.log.info("Log output for %s:", info["name"])
-                self.log.info(">>>>>>>")
-                for line in outputs[info['name']].splitlines():
-                    #TODO: make structured log messages human-readable
-                    self.log.info(line)
-                self.log.info("<<<<<<<")
-        return pass_count, fail_count
+            if info['name'] not in outputs:
+                continue
+            try:
+                dm = info['dm']
+                if not isinstance(dm, LocalDevice):
+                    # The DeviceManager of the client is busy running the browser.
+                    dm = create_device(info['host'])
+                dm.killProcess(info['remote_app_path'], sig=9 if force else None)
+            except DMError as e:
+                self.log.error("Error killing browser on %s: %s", info['name'], e.msg)
+
+def serve_shards(static, tests, sessions, durations, prefix="/"):
+    """Split |tests| between |sessions| of clients and serve the manifest of
+    the i-th returned session at |prefix|manifest/i.json. Return the sessions
+    and their tests, sessions without tests are left out."""
+    shards = shard_tests(tests, len(sessions), durations)
+    # Leave sessions without any tests idle.
+    sessions = [session for session, shard in zip(sessions, shards) if shard]
+    shards = [shard for shard in shards if shard]
+    for i, shard in enumerate(shards):
+        static.add("%smanifest/%d.json" % (prefix, i), json.dumps({"tests": shard}),
+                   "application/json")
+    return sessions, shards
+
+def read_manifest(path):
+    """Return the active tests of the manifest at |path| the way the
+    harness reads them: {"tests": [{"path": ..., "timeout": ...,
+    "exclusive": ...}, ...]}, leaving out unset keys."""
+    manifest = TestManifest(strict=False)
+    manifest.read(path)
+    manifest_data = {"tests": []}
+    for t in manifest.active_tests(disabled=False, **mozinfo.info):
+        test = {"path": t["relpath"]}
+        if "timeout" in t:
+            test["timeout"] = int(t["timeout"])
+        if t.get("exclusive", "false").lower() in ("true", "1", "yes"):
+            test["exclusive"] = True
+        manifest_data["tests"].append(test)
+    return manifest_data
+
+def report_timing(results, log, options, relay=None):
+    """Log the slowest tests and the tests whose duration differs most
+    between clients, and write the timing report. It includes the message
+    latency of the signalling |relay| if one was used."""
+    slowest = results.slowest(10)
+    if slowest:
+        log.info("Slowest tests:")
+        for test in slowest:
+            log.info("  %.2fs %s on %s (load %s, handshake %s, run %s)" % (
+                test.duration(), test.path, test.client,
+                format_seconds(test.load_time), format_seconds(test.handshake_time),
+                format_seconds(test.run_time)))
+    skews = results.skews(10)
+    if skews:
+        log.info("Biggest differences between clients:")
+        for path, skew in skews:
+            log.info("  %.2fs %s" % (skew, path))
+    report = results.timing_report()
+    if relay:
+        report["signalling"] = relay.latency_summary()
+        for name in ("delivery", "round_trip"):
+            if name in report["signalling"]:
+                times = report["signalling"][name]
+                log.info("Signalling %s time: median %.1fms, 95th percentile %.1fms, max %.1fms" % (
+                    name.replace("_", " "), times["median"] * 1000,
+                    times["p95"] * 1000, times["max"] * 1000))
+
+    report_path = options.timing_report
+    if not report_path and options.log_dest:
+        report_path = os.path.join(options.log_dest, "timing.json")
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+def report_results(merged, log, options, errors=()):
+    """Log the outcome of the MergedResults |merged| and the |errors|
+    outside of tests with the output around each failure, and write the
+    reports."""
+    lines = text_report(merged, errors)
+    for line in lines:
+        log.info(line)
+    if options.log_dest:
+        with open(os.path.join(options.log_dest, "report.txt"), "w") as f:
+            f.write(("\n".join(lines) + "\n").encode("utf-8"))
+    json_path = options.json_report
+    if not json_path and options.log_dest:
+        json_path = os.path.join(options.log_dest, "results.json")
+    if json_path:
+        write_json(merged, json_path, errors)
+    xunit_path = options.xunit_report
+    if not xunit_path and options.log_dest:
+        xunit_path = os.path.join(options.log_dest, "results.xml")
+    if xunit_path:
+        write_xunit(merged, xunit_path, errors=errors)
+
+def read_saved_logs(paths):
+    """Return the ResultSet of the client logs at |paths|, which are named
+    after their clients like those written with --save-logs-to."""
+    results = ResultSet()
+    for path in paths:
+        client = os.path.splitext(os.path.basename(path))[0]
+        results.update(read_log(path, client))
+    return results
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "n/a"
+    return "%.2fs" % seconds
 
 def get_package_options(parser, options):
     """Return a dictionary of package/binary options."""
@@ -403,8 +1673,12 @@ def get_package_options(parser, options):
 
 def main(args):
     parser = Options()
-    options, args = parser.parse_args()
-    if not options.html_manifest or not options.specialpowers or not options.host1 or not options.host2 or not options.signalling_server:
+    options, args = parser.parse_args(args)
+    if options.from_logs:
+        return report_saved_logs(parser, options)
+    have_hosts = options.hosts or options.hosts_file or (options.host1 and options.host2) or options.local
+    have_signalling = options.signalling_server or options.builtin_signalling
+    if not options.html_manifest or not options.specialpowers or not have_hosts or not have_signalling:
         parser.print_usage()
         return 2
 
@@ -422,56 +1696,161 @@ def main(args):
     if options.log_dest and not os.path.isdir(options.log_dest):
         parser.error("Log directory %s does not exist" % options.log_dest)
         return 2
+    if options.hosts_file and not os.path.isfile(options.hosts_file):
+        parser.error("Hosts file %s does not exist" % options.hosts_file)
+        return 2
+    if options.test_durations and not os.path.isfile(options.test_durations):
+        parser.error("Test durations file %s does not exist" % options.test_durations)
+        return 2
+    if options.rerun_failures and not options.results_db:
+        parser.error("--rerun-failures needs --results-db")
+        return 2
+    if (options.profile or options.cprofile) and not options.log_dest:
+        parser.error("--profile and --cprofile need --save-logs-to")
+        return 2
+    if options.session_size < 2:
+        parser.error("A session needs at least 2 clients")
+        return 2
+    if options.roles and len(options.roles.split(',')) != options.session_size:
+        parser.error("Need %d roles, got %d" % (options.session_size,
+                                                 len(options.roles.split(','))))
+        return 2
+    hosts = read_hosts(options)
+    if not hosts or len(hosts) % options.session_size:
+        parser.error("Need a multiple of %d hosts, got %d" % (options.session_size, len(hosts)))
+        return 2
 
     log = mozlog.getLogger('steeplechase')
     log.setLevel(mozlog.DEBUG)
-    if ':' in options.host1:
-        host, port = options.host1.split(':')
-        dm1 = DeviceManagerSUT(host, port)
-    else:
-        dm1 = DeviceManagerSUT(options.host1)
-    if ':' in options.host2:
-        host, port = options.host2.split(':')
-        dm2 = DeviceManagerSUT(host, port)
-    else:
-        dm2 = DeviceManagerSUT(options.host2)
-    remote_info = [{'dm': dm1,
-                    'binary': package_options.binary,
-                    'package': package_options.package,
-                    'is_initiator': True,
-                    'name': 'Client1'},
-                   {'dm': dm2,
-                    'binary': package_options.binary2,
-                    'package': package_options.package2,
-                    'is_initiator': False,
-                    'name': 'Client2'}]
+    return call_profiled(options, "controller", run_tests, options, package_options, hosts, log)
+
+def report_saved_logs(parser, options):
+    """Report the results in the client logs of --from-logs like those of
+    a run. Return True if all tests passed."""
+    paths = [path.strip() for path in options.from_logs.split(',') if path.strip()]
+    for path in paths:
+        if not os.path.isfile(path):
+            parser.error("Log %s does not exist" % path)
+            return False
+    if options.log_dest and not os.path.isdir(options.log_dest):
+        parser.error("Log directory %s does not exist" % options.log_dest)
+        return False
+    log = mozlog.getLogger('steeplechase')
+    log.setLevel(mozlog.DEBUG)
+    results = read_saved_logs(paths)
+    merged = results.merged()
+    errors = results.errors()
+    report_timing(results, log, options)
+    report_results(merged, log, options, errors)
+    pass_count = sum(1 for test in merged if test.outcome == "pass")
+    fail_count = sum(1 for test in merged if test.outcome == "fail")
+    log.info("Result summary:")
+    log.info("Passed: %d" % pass_count)
+    log.info("Failed: %d" % fail_count)
+    if errors:
+        log.info("Errors outside of tests: %d" % len(errors))
+    return pass_count > 0 and fail_count == 0 and not errors
+
+def select_tests(tests, db, options, log):
+    """Return the manifest entries of |tests| to run and the durations in
+    seconds to shard them by. With the results database |db| recently failed
+    tests run first, and with --rerun-failures only those that failed in the
+    last run are left."""
+    durations = {}
+    if db:
+        if options.rerun_failures:
+            failed = db.last_failures() or set()
+            # Failures of the harness or the controller aren't tests that can run again.
+            for path in sorted(failed - set(t["path"] for t in tests)):
+                log.warning("%s failed in the last run but is not a test of the manifest, "
+                            "not rerunning it" % path)
+            tests = [t for t in tests if t["path"] in failed]
+            if not tests:
+                log.info("No tests failed in the last run, nothing to rerun")
+        tests = failures_first(tests, db.recent_failures())
+        durations = db.durations()
+    if options.test_durations:
+        with open(options.test_durations) as f:
+            durations = json.load(f)
+        # Also accept a timing report of an earlier run.
+        durations = durations.get("durations", durations)
+    return tests, durations
+
+def run_with_retries(httpd, static, tests, all_sessions, durations, log, options, db=None,
+                     prefix="/", on_record=None, relay=None, timer=None):
+    """Run |tests| on the sessions of clients |all_sessions| and record the
+    results in the results database |db|. With --retry-failures the tests
+    that failed run again in new browsers, and count with the outcome of the
+    retry. Return the ResultSet. The other arguments are those of run_shards."""
+    timer = timer or PhaseTimer()
+    sessions, shards = serve_shards(static, tests, all_sessions, durations, prefix)
+    started = time.time()
+    results = run_shards(httpd, sessions, shards, log, options, prefix=prefix,
+                         on_record=on_record, relay=relay)
+    if db:
+        db.record_run(results, "rerun" if options.rerun_failures else "run", started)
+    failed = [t for t in tests if results.failed(t["path"])]
+    if options.retry_failures and failed:
+        log.info("Retrying %d failed tests in new browsers..." % len(failed))
+        timer.begin("retry")
+        # The shards replace those of the first pass.
+        sessions, shards = serve_shards(static, failed, all_sessions, durations, prefix)
+        started = time.time()
+        retry = run_shards(httpd, sessions, shards, log, options, append_logs=True,
+                           prefix=prefix, on_record=on_record, relay=relay)
+        if db:
+            db.record_run(retry, "retry", started)
+        for t in failed:
+            if not retry.failed(t["path"]):
+                log.warning("%s failed but passed on retry, it is intermittent" % t["path"])
+        # The outcome of retried tests is that of the retry.
+        results = results.without([t["path"] for t in failed])
+        results.update(retry)
+    return results
+
+def run_tests(options, package_options, hosts, log):
+    """Run the tests of the manifest on |hosts| and log the results. Return
+    True if all of them passed."""
+    timer = PhaseTimer()
+    timer.begin("manifest")
+    manifest_data = read_manifest(options.html_manifest)
+    db = None
+    if options.results_db:
+        db = ResultsDatabase(options.results_db)
+    manifest_data["tests"], durations = select_tests(manifest_data["tests"], db, options, log)
+    if options.rerun_failures and not manifest_data["tests"]:
+        db.close()
+        return True
+
+    remote_info = []
+    for i, host in enumerate(hosts):
+        index = i % options.session_size
+        first = index == 0
+        remote_info.append({'dm': create_device(host),
+                            'host': host,
+                            'binary': package_options.binary if first else package_options.binary2,
+                            'package': package_options.package if first else package_options.package2,
+                            'is_initiator': first,
+                            'index': index,
+                            'role': client_role(options, index),
+                            'name': 'Client%d' % (i + 1)})
     # first, push app
-    for info in remote_info:
-        dm = info['dm']
-
-        if info['binary']:
-            asset = Binary(path=info['binary'], log=log, dm=info['dm'], name=info['name'])
-        else:
-            asset = generate_package_asset(path=info['package'], log=log, dm=info['dm'], name=info['name'])
-
-        if options.setup:
-            asset.setup_test_root()
-        info['test_root'] = asset.test_root()
-
-        if options.setup:
-            log.info("Pushing app to %s...", info["name"])
-            asset.setup_client()
-        info['remote_app_path'] = asset.path_to_launch()
-        if not options.setup and not dm.fileExists(info['remote_app_path']):
-            log.error("App does not exist on %s, don't use --noSetup", info['name'])
-            return 2
+    timer.begin("setup")
+    errors = setup_clients(remote_info, log, options)
+    if errors:
+        for name in sorted(errors):
+            log.error("%s: %s", name, errors[name])
+        if db:
+            db.close()
+        return False
 
     pass_count, fail_count = 0, 0
+    errors = []
     if options.html_manifest:
-        manifest = TestManifest(strict=False)
-        manifest.read(options.html_manifest)
-        manifest_data = {"tests": [{"path": t["relpath"]} for t in manifest.active_tests(disabled=False, **mozinfo.info)]}
+        size = options.session_size
+        all_sessions = [remote_info[i:i + size] for i in range(0, len(remote_info), size)]
 
+        timer.begin("serve")
         remote_port = 0
         if options.remote_webserver:
             result = re.search(':(\d+)', options.remote_webserver)
@@ -479,28 +1858,54 @@ def main(args):
                 remote_port = int(result.groups()[0])
 
 
-        @json_response
-        def get_manifest(req):
-            return (200, manifest_data)
-        handlers = [{
-            'method': 'GET',
-            'path': '/manifest.json',
-            'function': get_manifest
-            }]
-        httpd = MozHttpd(host=moznetwork.get_ip(), port=remote_port, log_requests=True,
-                         docroot=os.path.join(os.path.dirname(__file__), "..", "webharness"),
-                         urlhandlers=handlers,
-                         path_mappings={"/tests": os.path.dirname(options.html_manifest)})
+        # The harness, the tests and the manifests are read and serialized
+        # once and served from memory.
+        static = StaticFiles()
+        static.add_directory("/", os.path.join(os.path.dirname(__file__), "..", "webharness"))
+        static.add_directory("/tests", os.path.dirname(options.html_manifest))
+        static.add("/manifest.json", json.dumps(manifest_data), "application/json")
+        handlers = []
+        relay = None
+        if options.builtin_signalling:
+            relay = SignallingRelay()
+            handlers.extend(relay.urlhandlers())
+        stats = StatsCollector()
+        handlers.extend(stats.urlhandlers())
+        handlers.extend(static.urlhandlers())
+        httpd = MozHttpd(host=moznetwork.get_ip(), port=remote_port,
+                         log_requests=options.log_requests,
+                         urlhandlers=handlers)
         httpd.start(block=False)
-        test = HTMLTests(httpd, remote_info, log, options)
-        html_pass_count, html_fail_count = test.run()
-        pass_count += html_pass_count
-        fail_count += html_fail_count
+        timer.begin("run")
+        results = run_with_retries(httpd, static, manifest_data["tests"], all_sessions,
+                                   durations, log, options, db=db, relay=relay, timer=timer)
+        # Each test counts once, as failed if it failed on any client.
+        merged = results.merged()
+        errors = results.errors()
+        pass_count += sum(1 for test in merged if test.outcome == "pass")
+        fail_count += sum(1 for test in merged if test.outcome == "fail")
+        timer.begin("report")
+        if relay:
+            relay.close()
         httpd.stop()
+        report_timing(results, log, options, relay)
+        stats.report(log, options.log_dest)
+        report_results(merged, log, options, errors)
+    if db:
+        db.close()
+    timer.end()
+    if options.profile:
+        log.info("Controller phases took %.2fs (%s)", timer.total(), timer.summary())
     log.info("Result summary:")
     log.info("Passed: %d" % pass_count)
     log.info("Failed: %d" % fail_count)
-    return pass_count > 0 and fail_count == 0
+    if errors:
+        log.info("Errors outside of tests: %d" % len(errors))
+    return pass_count > 0 and fail_count == 0 and not errors
 
 if __name__ == '__main__':
-    sys.exit(0 if main(sys.argv[1:]) else 1)
+    result = main(sys.argv[1:])
+    # Usage errors return their exit code, runs whether they passed.
+    if type(result) is int:
+        sys.exit(result)
+    sys.exit(0 if result else 1)
@@ -0,0 +1,159 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from StringIO import StringIO
+from urllib import unquote
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import threading
+
+# Files larger than this are read from disk for every request.
+MAX_CACHED_SIZE = 4 * 1024 * 1024
+# Responses smaller than this are not worth compressing.
+MIN_COMPRESSED_SIZE = 512
+COMPRESSED_TYPES = ("text/", "application/javascript", "application/json",
+                    "application/x-javascript", "image/svg+xml")
+
+def gzip_data(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6, mtime=0)
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+class Resource(object):
+    """A response body with its content type, ETag and compressed body,
+    if compressing it helps. Clients may use it for |max_age| seconds
+    without revalidating."""
+
+    def __init__(self, data, content_type, max_age=0):
+        self.data = data
+        self.content_type = content_type
+        self.max_age = max_age
+        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        self.compressed = None
+        if (len(data) >= MIN_COMPRESSED_SIZE and
+            content_type.startswith(COMPRESSED_TYPES)):
+            compressed = gzip_data(data)
+            if len(compressed) < len(data):
+                self.compressed = compressed
+
+class StaticFiles(object):
+    """Serves files from directories and in-memory resources for MozHttpd,
+    instead of its own file serving that reads every file from disk for every
+    request. Files are read and compressed once, and responses carry an ETag
+    so clients can revalidate instead of loading them again. Files don't
+    change during a run and every run starts with a new profile, so clients
+    may cache them for |max_age| seconds."""
+
+    def __init__(self, max_age=3600):
+        self.max_age = max_age
+        self.roots = []
+        self.resources = {}
+        self.lock = threading.Lock()
+
+    def add_directory(self, prefix, path, preload=True):
+        """Serve the files in |path| under the URL |prefix|. Unless |preload|
+        is False, all files are read now, otherwise on first request."""
+        prefix = "/" + prefix.strip("/")
+        # Longer prefixes take precedence. The list is replaced rather than
+        # changed, requests may be looking through it.
+        self.roots = sorted(self.roots + [(prefix.rstrip("/") + "/", path)],
+                            key=lambda root: -len(root[0]))
+        if not preload:
+            return
+        for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+            for filename in filenames:
+                rel = os.path.relpath(os.path.join(dirpath, filename), path)
+                url = posixpath.join(prefix, rel.replace(os.sep, "/"))
+                self.load(url, os.path.join(dirpath, filename))
+
+    def add(self, url, data, content_type, max_age=0):
+        """Serve |data| at |url|. By default clients revalidate it every
+        time they use it."""
+        resource = Resource(data, content_type, max_age)
+        with self.lock:
+            self.resources[url] = resource
+
+    def remove(self, prefix):
+        """Stop serving the directories and resources under the URL
+        |prefix|."""
+        prefix = "/" + prefix.strip("/") + "/"
+        self.roots = [root for root in self.roots if not root[0].startswith(prefix)]
+        with self.lock:
+            for url in [url for url in self.resources if url.startswith(prefix)]:
+                del self.resources[url]
+
+    def load(self, url, path):
+        """Read the file at |path| into the resource of |url| and return
+        it, or None if it can't be cached."""
+        if not os.path.isfile(path) or os.path.getsize(path) > MAX_CACHED_SIZE:
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        self.add(url, data, self.content_type(path), self.max_age)
+        return self.resources[url]
+
+    def content_type(self, path):
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        return content_type
+
+    def find_file(self, url):
+        """Return the path of the file at |url|, or None if there is none.
+        Paths outside of the directories are never returned."""
+        for prefix, root in self.roots:
+            if not url.startswith(prefix):
+                continue
+            rel = posixpath.normpath(url[len(prefix):])
+            if rel.startswith("../") or rel == ".." or rel.startswith("/"):
+                return None
+            path = os.path.join(root, *rel.split("/"))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def get(self, request, path):
+        """MozHttpd urlhandler function serving all files and resources."""
+        url = "/" + unquote(path)
+        if url.endswith("/"):
+            url += "index.html"
+        resource = self.resources.get(url)
+        if resource is None:
+            file_path = self.find_file(url)
+            if file_path is None:
+                return (404, {"Content-Type": "text/plain"}, "Not found")
+            resource = self.load(url, file_path)
+            if resource is None:
+                # Too large to keep around.
+                with open(file_path, "rb") as f:
+                    resource = Resource(f.read(), self.content_type(file_path),
+                                        self.max_age)
+
+        headers = {"Content-Type": resource.content_type,
+                   "ETag": resource.etag,
+                   "Cache-Control": ("max-age=%d" % resource.max_age
+                                     if resource.max_age else "no-cache"),
+                   "Vary": "Accept-Encoding"}
+        if request.headers.get("If-None-Match") == resource.etag:
+            headers["Content-Length"] = 0
+            return (304, headers, "")
+        data = resource.data
+        if resource.compressed and "gzip" in request.headers.get("Accept-Encoding", ""):
+            data = resource.compressed
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = len(data)
+        return (200, headers, data)
+
+    def urlhandlers(self):
+        """Return the MozHttpd urlhandlers serving the files. They match
+        every path, so they must come after all other handlers."""
+        return [{'method': 'GET',
+                 'path': r'/(.*)$',
+                 'function': self.get}]
@@ -0,0 +1,185 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from mozhttpd.handlers import json_response
+
+import json
+import os
+import threading
+
+INBOUND_TYPES = ("inbound-rtp", "inboundrtp")
+OUTBOUND_TYPES = ("outbound-rtp", "outboundrtp")
+CANDIDATE_PAIR_TYPES = ("candidate-pair", "candidatepair")
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2] if values else None
+
+def sample_metrics(stats):
+    """Return the metrics of one getStats() sample, a list of stats objects:
+    byte and packet counters, jitter and round trip time in ms."""
+    inbound = [s for s in stats if s.get("type") in INBOUND_TYPES and not s.get("isRemote")]
+    outbound = [s for s in stats if s.get("type") in OUTBOUND_TYPES and not s.get("isRemote")]
+    metrics = {"bytes_received": sum(s.get("bytesReceived", 0) for s in inbound),
+               "bytes_sent": sum(s.get("bytesSent", 0) for s in outbound),
+               "packets_received": sum(s.get("packetsReceived", 0) for s in inbound),
+               "packets_lost": sum(s.get("packetsLost", 0) for s in inbound)}
+    jitters = [s["jitter"] for s in inbound if s.get("jitter") is not None]
+    if jitters:
+        metrics["jitter"] = max(jitters) * 1000
+    rtts = [s["currentRoundTripTime"] * 1000 for s in stats
+            if s.get("type") in CANDIDATE_PAIR_TYPES and s.get("currentRoundTripTime") is not None
+            and (s.get("selected") or s.get("nominated"))]
+    rtts += [s["roundTripTime"] * 1000 for s in stats
+             if s.get("type") == "remote-inbound-rtp" and s.get("roundTripTime") is not None]
+    # Older versions of Firefox report it on the remote side of an RTP stream.
+    rtts += [s["mozRtt"] for s in stats if s.get("isRemote") and s.get("mozRtt") is not None]
+    if rtts:
+        metrics["rtt"] = max(rtts)
+    return metrics
+
+class StatsSeries(object):
+    """The getStats() samples of one peer connection of an attempt at a test
+    on a client."""
+
+    def __init__(self, test, client, attempt, pc):
+        self.test = test
+        self.client = client
+        self.attempt = attempt
+        self.pc = pc
+        self.ice_states = []
+        self.samples = []
+
+    def add(self, sample):
+        if "ice_state" in sample:
+            self.ice_states.append((sample["time"], sample["ice_state"]))
+        if "stats" in sample:
+            metrics = sample_metrics(sample["stats"])
+            metrics["time"] = sample["time"]
+            self.samples.append(metrics)
+
+    def ice_time(self):
+        """Return the ms from the start of the collection until ICE
+        connected, or None if it never did."""
+        if not self.ice_states:
+            return None
+        for time, state in self.ice_states:
+            if state in ("connected", "completed"):
+                return time - self.ice_states[0][0]
+        return None
+
+    def bitrate(self, counter):
+        """Return the average kbit/s of the byte |counter| over the series."""
+        if len(self.samples) < 2:
+            return None
+        first, last = self.samples[0], self.samples[-1]
+        duration = (last["time"] - first["time"]) / 1000.0
+        if duration <= 0:
+            return None
+        return (last[counter] - first[counter]) * 8 / duration / 1000
+
+    def summary(self):
+        rtts = [s["rtt"] for s in self.samples if "rtt" in s]
+        jitters = [s["jitter"] for s in self.samples if "jitter" in s]
+        loss = None
+        if self.samples:
+            last = self.samples[-1]
+            total = last["packets_received"] + last["packets_lost"]
+            if total:
+                loss = float(last["packets_lost"]) / total
+        return {"test": self.test,
+                "client": self.client,
+                "attempt": self.attempt,
+                "pc": self.pc,
+                "samples": len(self.samples),
+                "ice_state": self.ice_states[-1][1] if self.ice_states else None,
+                "ice_time": self.ice_time(),
+                "rtt_median": median(rtts),
+                "rtt_max": max(rtts) if rtts else None,
+                "jitter_median": median(jitters),
+                "jitter_max": max(jitters) if jitters else None,
+                "receive_kbps": self.bitrate("bytes_received"),
+                "send_kbps": self.bitrate("bytes_sent"),
+                "packet_loss": loss}
+
+class StatsCollector(object):
+    """Receives the getStats() samples the clients post to /stats in
+    batches, and keeps them as a series per peer connection of each test
+    on each client. A test that runs again in a later launch of the browser,
+    after a hang or as a retry, is a new attempt with series of its own."""
+
+    def __init__(self):
+        self.series = {}
+        # The launches each test ran in on each client, in order.
+        self.launches = {}
+        self.lock = threading.Lock()
+
+    def add(self, client, samples, launch=None):
+        """Add the |samples| of |client| posted by its browser of |launch|."""
+        with self.lock:
+            for sample in samples:
+                launches = self.launches.setdefault((sample.get("test"), client), [])
+                if launch not in launches:
+                    launches.append(launch)
+                key = (sample.get("test"), client, launches.index(launch) + 1, sample.get("pc"))
+                if key not in self.series:
+                    self.series[key] = StatsSeries(*key)
+                self.series[key].add(sample)
+
+    def post(self, body):
+        """Add the batch of samples posted as the JSON |body|. Return the
+        status and content of the response."""
+        try:
+            batch = json.loads(body)
+            self.add(batch["client"], batch["samples"], batch.get("launch"))
+        except (TypeError, ValueError, KeyError):
+            return (400, {})
+        return (200, {})
+
+    def urlhandlers(self):
+        """Return the MozHttpd urlhandlers receiving the samples."""
+        @json_response
+        def post_stats(req):
+            return self.post(req.body)
+
+        return [{'method': 'POST',
+                 'path': '/stats$',
+                 'function': post_stats}]
+
+    def summaries(self):
+        with self.lock:
+            return [self.series[key].summary() for key in sorted(self.series)]
+
+    def report(self, log, log_dest=None):
+        """Log a summary of every series. If |log_dest| is given, write the
+        summaries to stats.json and all samples to stats-series.json in it."""
+        if not self.series:
+            return
+        log.info("WebRTC statistics:")
+        for s in self.summaries():
+            attempt = ", attempt %d" % s["attempt"] if s["attempt"] > 1 else ""
+            log.info("  %s on %s (%s%s): ICE %s after %s ms, RTT %s ms, jitter %s ms, "
+                     "receive %s kbit/s, send %s kbit/s, loss %s" % (
+                     s["test"], s["client"], s["pc"], attempt, s["ice_state"],
+                     format_number(s["ice_time"]), format_number(s["rtt_median"]),
+                     format_number(s["jitter_median"]), format_number(s["receive_kbps"]),
+                     format_number(s["send_kbps"]), format_number(s["packet_loss"], "%.2f%%", 100)))
+        if not log_dest:
+            return
+        with open(os.path.join(log_dest, "stats.json"), "w") as f:
+            json.dump(self.summaries(), f, indent=2, sort_keys=True)
+        with self.lock, open(os.path.join(log_dest, "stats-series.json"), "w") as f:
+            # One line per series, so large runs can be read incrementally.
+            for key in sorted(self.series):
+                series = self.series[key]
+                json.dump({"test": series.test, "client": series.client,
+                           "attempt": series.attempt, "pc": series.pc,
+                           "ice_states": series.ice_states, "samples": series.samples},
+                          f, sort_keys=True, separators=(',', ':'))
+                f.write("\n")
+
+def format_number(value, format="%.0f", scale=1):
+    if value is None:
+        return "n/a"
+    return format % (value * scale)
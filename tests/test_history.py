@@ -0,0 +1,71 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from history import ResultsDatabase, failures_first
+from results import ResultSet
+
+def results(*tests):
+    """Return a ResultSet of (path, client, failures, status, seconds) tuples."""
+    results = ResultSet()
+    for path, client, failures, status, seconds in tests:
+        test = results.get(path, client)
+        test.passes = 0 if failures else 1
+        test.failures = failures
+        test.status = status
+        test.start_time = 0.0
+        test.end_time = seconds
+        results.passes += test.passes
+        results.failures += failures
+    return results
+
+class FailuresFirstTest(unittest.TestCase):
+    def test_order(self):
+        tests = [{"path": p} for p in ("a", "b", "c", "d")]
+        ordered = failures_first(tests, {"c": 3, "b": 7})
+        self.assertEqual([t["path"] for t in ordered], ["b", "c", "a", "d"])
+
+    def test_no_failures(self):
+        tests = [{"path": p} for p in ("a", "b")]
+        self.assertEqual(failures_first(tests, {}), tests)
+
+class ResultsDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.db = ResultsDatabase(":memory:")
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_empty(self):
+        self.assertEqual(self.db.last_failures(), None)
+        self.assertEqual(self.db.recent_failures(), {})
+        self.assertEqual(self.db.durations(), {})
+
+    def test_last_failures(self):
+        self.db.record_run(results(("a", "c1", 1, "finished", 1),
+                                   ("b", "c1", 0, "finished", 1)), "run", 0)
+        self.db.record_run(results(("a", "c1", 0, "finished", 1),
+                                   ("b", "c1", 0, None, 1),
+                                   ("c", "c1", 0, "finished", 1)), "run", 0)
+        # Reruns and retries don't replace the last first pass.
+        self.db.record_run(results(("b", "c1", 0, "finished", 1)), "retry", 0)
+        self.assertEqual(self.db.last_failures(), set(["b"]))
+
+    def test_recent_failures(self):
+        self.db.record_run(results(("a", "c1", 1, "finished", 1)), "run", 0)
+        self.db.record_run(results(("b", "c2", 0, None, 1)), "run", 0)
+        self.db.record_run(results(("a", "c1", 0, "finished", 1)), "run", 0)
+        self.assertEqual(self.db.recent_failures(), {"a": 1, "b": 2})
+        self.assertEqual(self.db.recent_failures(runs=2), {"b": 2})
+
+    def test_durations(self):
+        self.db.record_run(results(("a", "c1", 0, "finished", 2),
+                                   ("a", "c2", 0, "finished", 4)), "run", 0)
+        self.db.record_run(results(("a", "c1", 0, "finished", 8)), "run", 0)
+        self.assertEqual(self.db.durations(), {"a": 6.0})
+        self.assertEqual(self.db.durations(runs=1), {"a": 8.0})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import threading
+import time
+import unittest
+
+import relay
+from relay import Room, SignallingRelay
+
+class Request(object):
+    def __init__(self, query="", body=""):
+        self.query = query
+        self.body = body
+
+class RoomTest(unittest.TestCase):
+    def test_send_goes_to_other_clients(self):
+        room = Room()
+        self.assertEqual(room.join(), (0, 1))
+        self.assertEqual(room.join(), (1, 2))
+        room.send(0, "hello")
+        self.assertEqual([e["event"] for e in room.poll(0, 0)], ["client_joined"])
+        self.assertEqual([e.get("data") for e in room.poll(1, 0)], ["hello"])
+        self.assertEqual(room.poll(1, 0), [])
+
+    def test_leave_wakes_up_poll(self):
+        room = Room()
+        room.join()
+        polled = []
+        poll = threading.Thread(target=lambda: polled.append(room.poll(0, 10)))
+        poll.start()
+        time.sleep(0.1)
+        self.assertTrue(room.leave(0))
+        poll.join(5)
+        self.assertEqual(polled, [[]])
+
+    def test_poll_times_out(self):
+        room = Room()
+        room.join()
+        self.assertEqual(room.poll(0, 0.05), [])
+
+class SignallingRelayTest(unittest.TestCase):
+    def setUp(self):
+        self.relay = SignallingRelay(poll_timeout=0)
+        self.handlers = dict((h["path"].split("/")[-1].rstrip("$"), h["function"])
+                             for h in self.relay.urlhandlers())
+
+    def call(self, name, room, query="", body=""):
+        code, headers, data = self.handlers[name](Request(query, body), room)
+        return code, json.loads(data)
+
+    def test_messages(self):
+        self.assertEqual(self.call("join", "r"), (200, {"client": 0, "clients": 1}))
+        self.assertEqual(self.call("join", "r"), (200, {"client": 1, "clients": 2}))
+        self.assertEqual(self.call("send", "r", "client=0&rtt=20", "hello")[0], 200)
+        code, response = self.call("poll", "r", "client=1")
+        self.assertEqual([e["data"] for e in response["events"]], ["hello"])
+        self.assertTrue("queued" not in response["events"][0])
+        summary = self.relay.latency_summary()
+        self.assertEqual((summary["rooms"], summary["messages"]), (1, 1))
+        self.assertEqual(summary["round_trip"]["max"], 0.02)
+
+    def test_unknown_rooms_and_clients(self):
+        self.assertEqual(self.call("send", "r", "client=0", "x")[0], 404)
+        self.assertEqual(self.call("poll", "r", "client=0")[0], 404)
+        self.call("join", "r")
+        self.assertEqual(self.call("poll", "r", "client=5")[0], 404)
+
+    def test_rooms_are_dropped(self):
+        self.call("join", "r")
+        self.call("join", "r")
+        self.call("leave", "r", "client=0")
+        self.assertEqual(self.relay.rooms.keys(), ["r"])
+        self.call("leave", "r", "client=1")
+        self.assertEqual(self.relay.rooms, {})
+        self.call("join", "s")
+        self.relay.remove("s")
+        self.assertEqual(self.relay.rooms, {})
+
+    def test_latency_samples_are_capped(self):
+        self.call("join", "r")
+        self.call("join", "r")
+        for i in range(relay.MAX_LATENCY_SAMPLES + 5):
+            self.call("send", "r", "client=0&rtt=%d" % i, "m")
+        self.call("poll", "r", "client=1")
+        summary = self.relay.latency_summary()
+        self.assertEqual(summary["messages"], relay.MAX_LATENCY_SAMPLES + 5)
+        self.assertEqual(len(self.relay.delivery_times), relay.MAX_LATENCY_SAMPLES)
+        self.assertEqual(len(self.relay.round_trip_times), relay.MAX_LATENCY_SAMPLES)
+
+if __name__ == "__main__":
+    unittest.main()
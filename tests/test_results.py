@@ -0,0 +1,148 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import unittest
+
+from results import (ResultSet, StructuredLogParser, TestEnd, TestPass, TestStart,
+                     failure)
+
+def line(action, path, **fields):
+    fields.update(action=action, source_file=path)
+    return json.dumps(fields) + "\n"
+
+def run_test(path, passes=1, failures=0, status="finished", start=1000, end=3000):
+    """Return the output of a test as the harness logs it."""
+    output = line("test_start", path, index=0, time=start)
+    output += line("test_pass", path, message="ok", time=start) * passes
+    output += line("test_unexpected_fail", path, message="bad", time=start) * failures
+    if status:
+        output += line("test_end", path, index=0, status=status, time=end)
+    return output
+
+def parse(client, *outputs):
+    results = ResultSet()
+    parser = StructuredLogParser()
+    for output in outputs:
+        for record in parser.feed(output):
+            results.add(client, record)
+    for record in parser.close():
+        results.add(client, record)
+    return results
+
+class StructuredLogParserTest(unittest.TestCase):
+    def test_records(self):
+        parser = StructuredLogParser()
+        records = parser.feed("browser output\n" + run_test("a.html"))
+        self.assertEqual([type(r) for r in records], [TestStart, TestPass, TestEnd])
+        self.assertEqual(records[0].index, 0)
+        self.assertEqual(records[2].status, "finished")
+
+    def test_lines_split_across_chunks(self):
+        output = run_test("a.html", passes=2)
+        parser = StructuredLogParser()
+        records = []
+        for i in range(0, len(output), 7):
+            records.extend(parser.feed(output[i:i + 7]))
+        self.assertEqual([r.action for r in records],
+                         ["test_start", "test_pass", "test_pass", "test_end"])
+        self.assertEqual(parser.close(), [])
+
+    def test_carriage_returns(self):
+        parser = StructuredLogParser()
+        records = parser.feed(run_test("a.html").replace("\n", "\r\n"))
+        self.assertEqual([r.action for r in records], ["test_start", "test_pass", "test_end"])
+        self.assertEqual(records[0].source_file, "a.html")
+
+    def test_incomplete_last_line(self):
+        parser = StructuredLogParser()
+        self.assertEqual(parser.feed(line("test_pass", "a.html").rstrip("\n")), [])
+        records = parser.close()
+        self.assertEqual([r.action for r in records], ["test_pass"])
+        self.assertEqual(parser.close(), [])
+
+    def test_not_records(self):
+        parser = StructuredLogParser()
+        output = '{"no": "action"}\n{"action": broken}\n[1, 2]\n{not json "action"}\n'
+        self.assertEqual(parser.feed(output), [])
+        self.assertEqual([record for l, record in parser.parse("plain\n")], [None])
+
+class ResultSetTest(unittest.TestCase):
+    def test_merged(self):
+        results = parse("c1", run_test("a.html", passes=2), run_test("b.html"))
+        results.update(parse("c2", run_test("a.html", passes=3), run_test("b.html", failures=1)))
+        merged = dict((m.path, m) for m in results.merged())
+        self.assertEqual(merged["a.html"].outcome, "pass")
+        self.assertEqual(merged["a.html"].passes, 5)
+        self.assertEqual(merged["b.html"].outcome, "fail")
+        self.assertEqual(merged["a.html"].duration(), 2.0)
+        self.assertEqual((results.passes, results.failures), (7, 1))
+
+    def test_missing_test_end(self):
+        results = parse("c1", run_test("a.html", status=None))
+        self.assertTrue(results.failed("a.html"))
+        self.assertEqual(results.merged()[0].outcome, "fail")
+        self.assertEqual(results.merged()[0].duration(), None)
+
+    def test_missing_on_one_client(self):
+        results = parse("c1", run_test("a.html"))
+        results.expect("a.html", ["c1", "c2"])
+        self.assertTrue(results.failed("a.html"))
+        merged = results.merged()[0]
+        self.assertEqual(merged.outcome, "fail")
+        self.assertEqual(merged.clients.keys(), ["c1", "c2"])
+        self.assertEqual(merged.clients["c2"].status, None)
+
+    def test_expected_but_never_ran(self):
+        results = ResultSet()
+        results.expect("a.html", ["c1", "c2"])
+        self.assertTrue(results.failed("a.html"))
+        self.assertEqual(results.merged()[0].outcome, "fail")
+
+    def test_empty(self):
+        results = parse("c1", run_test("a.html", passes=0))
+        self.assertFalse(results.failed("a.html"))
+        self.assertEqual(results.merged()[0].outcome, "empty")
+
+    def test_errors(self):
+        results = parse("c1", run_test("a.html"))
+        results.add("c1", failure("Browser crashed"))
+        self.assertEqual([m.path for m in results.merged()], ["a.html"])
+        self.assertEqual([(c, r.message) for c, r in results.errors()],
+                         [("c1", "Browser crashed")])
+
+    def test_without(self):
+        results = parse("c1", run_test("a.html"), run_test("b.html", failures=2))
+        results.expect("b.html", ["c1"])
+        rest = results.without(["b.html"])
+        self.assertEqual([m.path for m in rest.merged()], ["a.html"])
+        self.assertEqual((rest.passes, rest.failures), (1, 0))
+        self.assertEqual(rest.expected.keys(), [])
+
+    def test_retry_merging(self):
+        # The outcome of a retried test is that of the retry, as in run_tests.
+        results = parse("c1", run_test("a.html"), run_test("b.html", failures=1))
+        results.update(parse("c2", run_test("a.html"), run_test("b.html", status=None)))
+        results.expect("b.html", ["c1", "c2"])
+        retry = parse("c3", run_test("b.html"))
+        retry.update(parse("c4", run_test("b.html")))
+        retry.expect("b.html", ["c3", "c4"])
+        results = results.without(["b.html"])
+        results.update(retry)
+        merged = dict((m.path, m) for m in results.merged())
+        self.assertEqual(merged["b.html"].outcome, "pass")
+        self.assertEqual(sorted(merged["b.html"].clients), ["c3", "c4"])
+        self.assertFalse(results.failed("b.html"))
+        self.assertEqual((results.passes, results.failures), (4, 0))
+
+    def test_update_same_client(self):
+        # Logs appended after a browser restart add to the earlier results.
+        results = parse("c1", run_test("a.html", status=None))
+        results.update(parse("c1", line("test_pass", "a.html") +
+                                   line("test_end", "a.html", status="finished", time=4000)))
+        test = results.get("a.html", "c1")
+        self.assertEqual((test.passes, test.status, test.duration()), (2, "finished", 3.0))
+
+if __name__ == "__main__":
+    unittest.main()
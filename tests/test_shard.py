@@ -0,0 +1,40 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from runsteeplechase import shard_tests
+
+def manifest(*paths):
+    return [{"path": p} for p in paths]
+
+def paths(shards):
+    return [[t["path"] for t in shard] for shard in shards]
+
+class ShardTestsTest(unittest.TestCase):
+    def test_without_durations(self):
+        shards = shard_tests(manifest("a", "b", "c", "d", "e"), 2)
+        self.assertEqual(sorted(len(s) for s in shards), [2, 3])
+        self.assertEqual(sorted(sum(paths(shards), [])), ["a", "b", "c", "d", "e"])
+
+    def test_balances_durations(self):
+        durations = {"a": 10, "b": 1, "c": 1, "d": 8, "e": 1, "f": 1}
+        shards = shard_tests(manifest("a", "b", "c", "d", "e", "f"), 2, durations)
+        self.assertEqual(sorted(sum(durations[p] for p in s) for s in paths(shards)), [11, 11])
+
+    def test_unknown_durations_take_the_average(self):
+        shards = shard_tests(manifest("a", "b", "c"), 2, {"a": 4, "b": 2})
+        self.assertEqual(sorted(paths(shards)), [["a"], ["b", "c"]])
+
+    def test_keeps_manifest_order(self):
+        durations = {"a": 1, "b": 5, "c": 2, "d": 3}
+        for shard in paths(shard_tests(manifest("a", "b", "c", "d"), 2, durations)):
+            self.assertEqual(shard, sorted(shard))
+
+    def test_more_shards_than_tests(self):
+        shards = shard_tests(manifest("a"), 3)
+        self.assertEqual(sorted(paths(shards)), [[], [], ["a"]])
+
+if __name__ == "__main__":
+    unittest.main()
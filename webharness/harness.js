@@ -1,16 +1,56 @@
 var tests = [];
-var current_test = -1;
-var current_window = null;
+// Index of the next test to start.
+var next_test = 0;
+// Indices of the tests the controller failed because a browser hung in
+// them. They are not run again when it restarts the browsers.
+var skip_tests = {};
+// Tests that are currently running, by index. Each has its window, timeout
+// and timestamps: window opened, page loaded, both sides loaded, run started.
+var running_tests = {};
+var running_count = 0;
+// Messages for each test by index, see socket_message.
+var channels = {};
+var finished_tests = {};
 var socket;
-var socket_messages = [];
-var socket_message_promises = [];
 var is_initiator = SpecialPowers.getBoolPref("steeplechase.is_initiator");
+// The index of this client in its session, starting at 0 for the
+// initiator, the number of clients in the session and this one's role.
+var client_index = get_int_pref("steeplechase.client_index", is_initiator ? 0 : 1);
+var num_clients = get_int_pref("steeplechase.num_clients", 2);
+var role = get_char_pref("steeplechase.role", is_initiator ? "initiator" : "responder");
+// How many tests to run at the same time.
+var concurrency = 1;
+// Whether to load the next test while others run, and the test
+// that was loaded that way but hasn't started yet.
+var preload = false;
+var preloaded_test = null;
+// getStats() samples waiting to be posted to the controller, see collect_stats.
+var stats_samples = [];
+var STATS_BATCH_SIZE = 50;
+var STATS_TYPES = ["inbound-rtp", "outbound-rtp", "remote-inbound-rtp",
+                   "candidate-pair", "inboundrtp", "outboundrtp", "candidatepair"];
+
+function get_char_pref(name, default_value) {
+  try {
+    return SpecialPowers.getCharPref(name);
+  } catch (e) {
+    return default_value;
+  }
+}
+
+function get_int_pref(name, default_value) {
+  try {
+    return SpecialPowers.getIntPref(name);
+  } catch (e) {
+    return default_value;
+  }
+}
 
 function fetch_manifest() {
   return new Promise((resolve, reject) => {
-    // Load test manifest
+    // Load test manifest, or the part of it this pair of clients runs.
     var req = new XMLHttpRequest();
-    req.open("GET", "/manifest.json", true);
+    req.open("GET", get_char_pref("steeplechase.manifest_url", "/manifest.json"), true);
     req.responseType = "json";
     req.overrideMimeType("application/json");
     req.onload = function() {
@@ -44,45 +84,142 @@ function load_script(script) {
 }
 
 /*
- * Receive a single message from |socket|. If
- * there is a deferred (from wait_for_message)
- * waiting on it, resolve that deferred. Otherwise
- * queue the message for a future waiter.
+ * Return the message queue of the test with index |index|.
+ * Messages can arrive before the test was started here.
+ */
+function get_channel(index) {
+  if (!(index in channels)) {
+    channels[index] = {messages: [], waiting: []};
+  }
+  return channels[index];
+}
+
+/*
+ * Receive a single message from |socket|. Messages are
+ * sent for a particular test, so tests running at the
+ * same time don't see each other's messages, and go to
+ * all other clients unless they name the one they are for.
+ * If a waiter (from wait_for_channel_message) on the
+ * test's channel accepts the message, resolve it.
+ * Otherwise queue the message for a future waiter.
  */
 function socket_message(data) {
   var message = JSON.parse(data);
-  if (socket_message_promises.length > 0) {
-    var res = socket_message_promises.shift();
-    res(message);
-  } else {
-    socket_messages.push(message);
+  var index = message.index;
+  if ("to" in message && message.to != client_index) {
+    return;
+  }
+  if (index in finished_tests) {
+    // Left over from a test that timed out.
+    return;
+  }
+  if (message.action == "test_timeout") {
+    // Another client gave up on a test, stop running it here too.
+    var test = running_tests[index] ||
+               (preloaded_test && preloaded_test.index == index ? preloaded_test : null);
+    if (test) {
+      log_result(false, "Test timed out on another client", test.path);
+      end_test(test, "aborted");
+    } else {
+      // Not opened here yet, so it is skipped when its turn comes.
+      if (index < tests.length) {
+        log_result(false, "Test timed out on another client", tests[index].path);
+        log_test_end({index: index, path: tests[index].path, times: {}}, "aborted");
+      }
+      finished_tests[index] = true;
+      delete channels[index];
+      skip_to_next_test();
+    }
+    return;
   }
+  var channel = get_channel(index);
+  for (var i = 0; i < channel.waiting.length; i++) {
+    if (channel.waiting[i].accepts(message)) {
+      channel.waiting.splice(i, 1)[0].resolve(message);
+      return;
+    }
+  }
+  channel.messages.push(message);
 }
 
 /*
- * Return a promise for the next available message
- * to come in on |socket|. If there is a queued
- * message, resolves the promise immediately, otherwise
- * waits for socket_message to receive one.
+ * Return the running or preloaded test whose window is |test_window|.
  */
-function wait_for_message() {
+function find_test(test_window) {
+  for (var index in running_tests) {
+    if (running_tests[index].window == test_window) {
+      return running_tests[index];
+    }
+  }
+  if (preloaded_test && preloaded_test.window == test_window) {
+    return preloaded_test;
+  }
+  return null;
+}
+
+/*
+ * Return a promise for the next message for the test with
+ * index |index| that the function |accepts| returns true for.
+ * If such a message is queued, resolves the promise immediately,
+ * otherwise waits for socket_message to receive one.
+ */
+function wait_for_channel_message(index, accepts) {
   return new Promise(resolve => {
-    if (socket_messages.length > 0) {
-      resolve(socket_messages.shift());
-    } else {
-      socket_message_promises.push(resolve);
+    var channel = get_channel(index);
+    for (var i = 0; i < channel.messages.length; i++) {
+      if (accepts(channel.messages[i])) {
+        resolve(channel.messages.splice(i, 1)[0]);
+        return;
+      }
     }
+    channel.waiting.push({accepts: accepts, resolve: resolve});
   });
 }
 
+/*
+ * Return a promise for the data of the next message to the
+ * test running in |test_window|, from the client with index
+ * |from| or, if it is undefined, from any client.
+ */
+function wait_for_message(test_window, from) {
+  var test = find_test(test_window);
+  if (!test) {
+    // The test was aborted, its messages are dropped.
+    return new Promise(resolve => {});
+  }
+  return wait_for_channel_message(test.index, function(m) {
+    return m.action != "test_loaded" && (from === undefined || m.from == from);
+  }).then(m => m.data);
+}
+
 /*
  * Send an object as a message on |socket|.
  */
-function send_message(data) {
-  socket.send(JSON.stringify(data));
+function send_socket_message(message) {
+  socket.send(JSON.stringify(message));
+}
+
+/*
+ * Send an object as a message from the test running in
+ * |test_window| to the client with index |to|, or to all
+ * other clients if it is undefined.
+ */
+function send_message(data, test_window, to) {
+  var test = find_test(test_window);
+  if (test) {
+    var message = {"index": test.index, "from": client_index, "data": data};
+    if (to !== undefined) {
+      message.to = to;
+    }
+    send_socket_message(message);
+  }
 }
 
 function connect_socket() {
+  var relay = get_char_pref("steeplechase.signalling_relay", "");
+  if (relay) {
+    return connect_relay(relay);
+  }
   var server = SpecialPowers.getCharPref("steeplechase.signalling_server");
   if (server.substr(server.length - 1) != "/") {
     server += "/";
@@ -106,15 +243,18 @@ function connect_socket() {
   }).then(function () {
     return new Promise((resolve, reject) => {
       socket.once("numclients", function(data) {
-        if (data.clients == 2) {
-          // Other side is already there.
+        var clients = data.clients;
+        if (clients == num_clients) {
+          // All other clients are already there.
           resolve(socket);
-        } else if (data.clients > 2) {
+        } else if (clients > num_clients) {
           reject(new Error("Too many clients connected"));
         } else {
-          // Just us, wait for the other side.
-          socket.once("client_joined", function() {
-            resolve(socket);
+          // Wait for the other clients.
+          socket.on("client_joined", function() {
+            if (++clients == num_clients) {
+              resolve(socket);
+            }
           });
         }
       });
@@ -122,6 +262,106 @@ function connect_socket() {
   });
 }
 
+/*
+ * Make a request to the controller's signalling relay and return
+ * a promise for the JSON response.
+ */
+function relay_request(method, url, body) {
+  return new Promise((resolve, reject) => {
+    var req = new XMLHttpRequest();
+    req.open(method, url, true);
+    req.responseType = "json";
+    req.overrideMimeType("application/json");
+    req.onload = function() {
+      if (req.status == 200) {
+        resolve(req.response);
+      } else {
+        reject(new Error("Signalling relay error " + req.status + ": " + url));
+      }
+    };
+    req.onerror = function() {
+      reject(new Error("Signalling relay request failed: " + url));
+    };
+    req.send(body);
+  });
+}
+
+/*
+ * Join the room on the signalling relay of the controller at
+ * |url| and poll it for messages. |socket| gets the send method
+ * of a socket.io socket, and a leave method that leaves the room.
+ * Resolves once all other clients have joined.
+ */
+function connect_relay(url) {
+  var room = url + SpecialPowers.getCharPref("steeplechase.signalling_room") + "/";
+  return relay_request("POST", room + "join", null).then(function(joined) {
+    var client = joined.client;
+    var clients = joined.clients;
+    // Round trip time of the last message, reported with the next one.
+    var rtt = null;
+    var sending = Promise.resolve();
+    var left = false;
+    socket = {
+      send: function(data) {
+        // One message at a time, so they arrive in order.
+        sending = sending.then(function() {
+          var start = Date.now();
+          var query = "?client=" + client + (rtt === null ? "" : "&rtt=" + rtt);
+          return relay_request("POST", room + "send" + query, data).then(function() {
+            rtt = Date.now() - start;
+          });
+        }).catch(harness_error);
+      },
+      leave: function() {
+        left = true;
+        return relay_request("POST", room + "leave?client=" + client, null).catch(function() {
+          // The controller drops the room when the run ends anyway.
+        });
+      }
+    };
+    return new Promise((resolve, reject) => {
+      var connected = false;
+      function connect() {
+        connected = true;
+        resolve(socket);
+      }
+      function poll() {
+        relay_request("GET", room + "poll?client=" + client, null).then(function(response) {
+          if (left) {
+            return;
+          }
+          response.events.forEach(function(e) {
+            if (e.event == "client_joined" && ++clients == num_clients) {
+              connect();
+            } else if (e.event == "message") {
+              socket_message(e.data);
+            }
+          });
+          poll();
+        }, function(error) {
+          if (left) {
+            return;
+          }
+          if (connected) {
+            harness_error(error);
+          } else {
+            reject(error);
+          }
+        });
+      }
+      if (clients > num_clients) {
+        reject(new Error("Too many clients connected"));
+        return;
+      }
+      if (clients == num_clients) {
+        // All other clients are already there.
+        connect();
+      }
+      poll();
+    });
+  });
+}
+
 Promise.all([fetch_manifest(),
              connect_socket()]).then(run_tests,
                                      harness_error);
@@ -129,49 +369,196 @@ Promise.all([fetch_manifest(),
 function run_tests(results) {
   var manifest = results[0];
   // Manifest looks like:
-  // {'tests': [{'path': '...'}, ...]}
+  // {'tests': [{'path': '...', 'exclusive': true}, ...]}
   tests = manifest.tests;
-  run_next_test();
+  concurrency = Math.max(1, get_int_pref("steeplechase.concurrency", 1));
+  // When the controller restarts a hung browser it resumes at a later test.
+  next_test = get_int_pref("steeplechase.start_test", 0);
+  get_char_pref("steeplechase.skip_tests", "").split(",").forEach(function(index) {
+    if (index) {
+      skip_tests[index] = true;
+    }
+  });
+  skip_to_next_test();
+  try {
+    preload = SpecialPowers.getBoolPref("steeplechase.preload");
+  } catch (e) {
+    preload = false;
+  }
+  run_next_tests();
 }
 
-function test_error(errorMsg, url, lineNumber) {
-  log_result(false, errorMsg + " @" + url + ":" + lineNumber, tests[current_test].path);
-  finish();
+/*
+ * Start tests until |concurrency| tests are running. A test marked
+ * exclusive in the manifest only starts once all others have finished,
+ * and no others start while it is running. The other clients make the
+ * same decisions, so all of them always run the same tests.
+ *
+ * With preloading, the test after the running ones is opened and
+ * loaded in the background, so it starts as soon as a slot is free.
+ */
+function run_next_tests() {
+  while (running_count < concurrency) {
+    var index = preloaded_test ? preloaded_test.index : next_test;
+    if (index >= tests.length || !may_start(index)) {
+      break;
+    }
+    var test = preloaded_test;
+    preloaded_test = null;
+    if (!test) {
+      test = open_test(take_next_test());
+      if (!test) {
+        return;
+      }
+    }
+    begin_test(test);
+  }
+  if (preload && !preloaded_test && next_test < tests.length &&
+      !tests[next_test].exclusive && !exclusive_running()) {
+    preloaded_test = open_test(take_next_test());
+  }
+  if (next_test >= tests.length && running_count == 0 && !preloaded_test) {
+    finish();
+  }
 }
 
-function run_next_test() {
-  ++current_test;
-  if (current_test >= tests.length) {
-    finish();
-    return;
+/*
+ * Return the index of the next test to open and move on to the one
+ * after it.
+ */
+function take_next_test() {
+  var index = next_test++;
+  skip_to_next_test();
+  return index;
+}
+
+/*
+ * Move |next_test| past the tests the controller skips and those
+ * another client timed out before they were opened here.
+ */
+function skip_to_next_test() {
+  while (next_test < tests.length &&
+         (skip_tests[next_test] || next_test in finished_tests)) {
+    next_test++;
+  }
+}
+
+function exclusive_running() {
+  return Object.keys(running_tests).some(i => tests[i].exclusive);
+}
+
+function may_start(index) {
+  if (running_count == 0) {
+    return true;
   }
+  return !tests[index].exclusive && !exclusive_running();
+}
 
-  var path = tests[current_test].path;
+/*
+ * Open the window of the test with index |index| and exchange
+ * test_loaded with all other clients once it has loaded. The test
+ * runs when both that is done and begin_test has been called.
+ */
+function open_test(index) {
+  var path = tests[index].path;
+  var test = {index: index, path: path, times: {start: Date.now()}};
   try {
-    current_window = window.open("/tests/" + path);
+    test.window = window.open(get_char_pref("steeplechase.tests_url", "/tests/") + path);
   } catch(ex) {
     harness_error(ex);
-    return;
+    return null;
   }
-  current_window.onerror = test_error;
-  current_window.addEventListener("load", function() {
+  test.window.onerror = function(errorMsg, url, lineNumber) {
+    log_result(false, errorMsg + " @" + url + ":" + lineNumber, path);
+    finish();
+  };
+  test.window.addEventListener("load", function() {
+    test.times.loaded = Date.now();
     dump("loaded " + path + "\n");
-    send_message({"action": "test_loaded", "test": path});
-    // Wait for other side to have loaded this test.
-    wait_for_message().then(function (m) {
-      if (m.action != "test_loaded") {
-        //XXX: should this be fatal?
-        harness_error(new Error("Looking for test_loaded, got: " + JSON.stringify(m)));
+    send_socket_message({"action": "test_loaded", "index": index, "test": path,
+                         "from": client_index});
+    // Wait for all other clients to have loaded this test.
+    var loaded = [];
+    for (var i = 1; i < num_clients; i++) {
+      loaded.push(wait_for_channel_message(index, m => m.action == "test_loaded"));
+    }
+    Promise.all(loaded).then(function (messages) {
+      var wrong = messages.filter(m => m.test != path);
+      if (wrong.length > 0) {
+        harness_error(new Error("Wrong test loaded on client " + wrong[0].from + ": " +
+                                JSON.stringify(wrong[0].test)));
         return;
       }
-      if (m.test != path) {
-        harness_error(new Error("Wrong test loaded on other side: " + JSON.stringify(m.test)));
+      if (test.ended) {
         return;
       }
-      current_window.run_test(is_initiator);
+      test.times.handshake = Date.now();
+      if (test.running) {
+        run_test(test);
+      }
     });
   });
-  //TODO: timeout handling
+  return test;
+}
+
+/*
+ * Count |test| as running and start its timeout. It runs right
+ * away if it was preloaded and both sides have loaded it.
+ */
+function begin_test(test) {
+  var index = test.index;
+  var path = test.path;
+  var timeout = tests[index].timeout ||
+                get_int_pref("steeplechase.test_timeout", 300);
+  test.running = true;
+  running_tests[index] = test;
+  running_count++;
+  dump(JSON.stringify({'action': "test_start",
+                       'index': index,
+                       'timeout': timeout,
+                       'time': Date.now(),
+                       'source_file': path}) + "\n");
+  test.timeout = setTimeout(function() {
+    log_result(false, "Test timed out after " + timeout + "s", path);
+    send_socket_message({"action": "test_timeout", "index": index, "test": path});
+    end_test(test, "timeout");
+  }, timeout * 1000);
+  if (test.times.handshake) {
+    run_test(test);
+  }
+}
+
+function run_test(test) {
+  test.times.run = Date.now();
+  test.window.run_test(is_initiator, {'index': client_index,
+                                      'num_clients': num_clients,
+                                      'role': role});
+}
+
+/*
+ * Remove |test| from the running or preloaded tests, log its end
+ * with |status| and start the next tests. This also stops tests
+ * that didn't finish, and messages that arrive for them later are
+ * dropped.
+ */
+function end_test(test, status) {
+  log_test_end(test, status);
+  clearTimeout(test.timeout);
+  if (test.stats_timers) {
+    test.stats_timers.forEach(clearInterval);
+    flush_stats();
+  }
+  test.ended = true;
+  test.window.close();
+  if (test == preloaded_test) {
+    preloaded_test = null;
+  } else {
+    delete running_tests[test.index];
+    running_count--;
+  }
+  delete channels[test.index];
+  finished_tests[test.index] = true;
+  setTimeout(run_next_tests, 0);
 }
 
 function harness_error(error) {
@@ -183,14 +570,110 @@ function harness_error(error) {
 addEventListener("error", harness_error);
 
 // Called by tests via test.js.
-function test_finished() {
-  current_window.close();
-  current_window = null;
-  setTimeout(run_next_test, 0);
+function test_finished(test_window) {
+  var test = find_test(test_window);
+  if (!test) {
+    // A test that was aborted finished after all.
+    return;
+  }
+  end_test(test, "finished");
 }
 
+var finishing = false;
+
 function finish() {
-  SpecialPowers.quit();
+  // Tests that end at the same time may each find nothing left to run.
+  if (finishing) {
+    return;
+  }
+  finishing = true;
+  flush_stats().then(leave_signalling).then(function() {
+    SpecialPowers.quit();
+  });
+}
+
+function leave_signalling() {
+  if (socket && socket.leave) {
+    return socket.leave();
+  }
+  return Promise.resolve();
+}
+
+// Called by test.js before the test's scripts run.
+function auto_collect_stats() {
+  return get_int_pref("steeplechase.stats_interval", 0) > 0;
+}
+
+/*
+ * Sample the statistics of the peer connection |pc| of the test in
+ * |test_window| until the test ends, and its ICE connection state
+ * whenever it changes. |label| tells the test's peer connections apart.
+ */
+function collect_stats(pc, label, test_window) {
+  var test = find_test(test_window);
+  if (!test) {
+    return;
+  }
+  if (!test.stats_timers) {
+    test.stats_timers = [];
+  }
+  var id = label || "pc" + test.stats_timers.length;
+  var interval = get_int_pref("steeplechase.stats_interval", 0) || 1000;
+  function ice_state_changed() {
+    add_stats_sample(test, id, {'ice_state': pc.iceConnectionState});
+  }
+  ice_state_changed();
+  pc.addEventListener("iceconnectionstatechange", ice_state_changed);
+  test.stats_timers.push(setInterval(function() {
+    if (test.ended || pc.signalingState == "closed") {
+      return;
+    }
+    pc.getStats(null).then(function(report) {
+      var stats = [];
+      report.forEach(function(stat) {
+        if (STATS_TYPES.indexOf(stat.type) != -1) {
+          stats.push(JSON.parse(JSON.stringify(stat)));
+        }
+      });
+      add_stats_sample(test, id, {'stats': stats});
+    }, function() {
+      // The peer connection is going away.
+    });
+  }, interval));
+}
+
+function add_stats_sample(test, id, sample) {
+  sample.test = test.path;
+  sample.pc = id;
+  sample.time = Date.now();
+  stats_samples.push(sample);
+  if (stats_samples.length >= STATS_BATCH_SIZE) {
+    flush_stats();
+  }
+}
+
+/*
+ * Post the collected samples to the controller. Returns a promise
+ * that resolves when it's done. Statistics that can't be posted are
+ * dropped, they never fail tests.
+ */
+function flush_stats() {
+  if (stats_samples.length == 0) {
+    return Promise.resolve();
+  }
+  var body = JSON.stringify({'client': get_char_pref("steeplechase.client_name", ""),
+                             'launch': get_char_pref("steeplechase.launch", ""),
+                             'samples': stats_samples});
+  stats_samples = [];
+  return new Promise((resolve) => {
+    var req = new XMLHttpRequest();
+    req.open("POST", get_char_pref("steeplechase.stats_url", "/stats"), true);
+    req.setRequestHeader("Content-Type", "application/json");
+    req.onload = req.onerror = function() {
+      resolve();
+    };
+    req.send(body);
+  });
 }
 
 function log(message, test, extra) {
@@ -198,10 +681,40 @@ function log(message, test, extra) {
   dump(message + "\n");
 }
 
+/*
+ * Log the end of |test| with the time spent loading it, waiting
+ * for the other clients to load it and running it, in ms. A preloaded
+ * test may wait between the handshake and running.
+ */
+function log_test_end(test, status) {
+  var end = Date.now();
+  var t = test.times;
+  function interval(from, to) {
+    return (from && to) ? to - from : null;
+  }
+  var output = {'action': "test_end",
+                'status': status,
+                'index': test.index,
+                'time': end,
+                'load_time': interval(t.start, t.loaded),
+                'handshake_time': interval(t.loaded, t.handshake),
+                'run_time': interval(t.run, end),
+                'source_file': test.path};
+  dump(JSON.stringify(output) + "\n");
+}
+
+/*
+ * Log a test result. |test| is the path of the test or the
+ * window it runs in.
+ */
 function log_result(result, message, test) {
+  if (typeof test != "string") {
+    var running = find_test(test);
+    test = running ? running.path : "harness.js";
+  }
   var output = {'action': result ? "test_pass" : "test_unexpected_fail",
                 'message': message,
                 'time': Date.now(),
-                'source_file': test || tests[current_test].path};
+                'source_file': test};
   dump(JSON.stringify(output) + "\n");
 }
@@ -1,8 +1,11 @@
-var log_result = window.opener.log_result;
 var info = window.opener.log;
 var pass_count = 0;
 var fail_count = 0;
 
+function log_result(result, message) {
+  window.opener.log_result(result, message, window);
+}
+
 function ok(condition, message) {
   log_result(!!condition, message);
 }
@@ -20,8 +23,41 @@ function todo(condition, message) {
 }
 
 function finish() {
-  window.opener.test_finished();
+  window.opener.test_finished(window);
 }
 
-var wait_for_message = window.opener.wait_for_message;
-var send_message = window.opener.send_message;
+// Messages only go to and come from the same test on the other clients.
+// |from| and |to| are the indexes of clients in the session, without them
+// messages come from any client and go to all.
+function wait_for_message(from) {
+  return window.opener.wait_for_message(window, from);
+}
+
+function send_message(data, to) {
+  window.opener.send_message(data, window, to);
+}
+
+// Sample the statistics of the RTCPeerConnection |pc| until the test
+// ends. The controller reports them and saves them with the logs.
+function collect_stats(pc, label) {
+  window.opener.collect_stats(pc, label, window);
+}
+
+// With --stats-interval, collect the statistics of every peer
+// connection the test creates.
+if (window.opener.auto_collect_stats()) {
+  ["RTCPeerConnection", "mozRTCPeerConnection"].forEach(function(name) {
+    var PeerConnection = window[name];
+    if (!PeerConnection) {
+      return;
+    }
+    var wrapper = function(configuration, constraints) {
+      var pc = new PeerConnection(configuration, constraints);
+      collect_stats(pc);
+      return pc;
+    };
+    wrapper.prototype = PeerConnection.prototype;
+    Object.setPrototypeOf(wrapper, PeerConnection);
+    window[name] = wrapper;
+  });
+}